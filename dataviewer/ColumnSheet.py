@@ -0,0 +1,66 @@
+import os
+import numpy
+
+from Data1DSheet import Data1DSheet
+import column_data as CD
+from Exceptions import *
+
+class ColumnSheet(Data1DSheet):
+    '''Holds a plain column data file, such as an XMU file'''
+
+    priority = 10
+
+    @staticmethod
+    def sniff(head):
+        '''a block of '#' comment lines, then numbers'''
+
+        return CD.sniff(head)
+
+    def getColumns(self):
+        '''returns the data whose columns are shown, with labels and get_data'''
+
+        return self.data
+
+    def getXData(self, name):
+        '''returns a 1D iterable of data for X axis
+
+        Args:
+            name: a column label'''
+
+        return self.getColumns().get_data(name)
+
+    def getXDataNames(self):
+
+        return list(self.getColumns().labels)
+
+    def getYDataNames(self):
+
+        return sum([ [n, "log %s" % n] for n in self.getColumns().labels], [])
+
+    def getYData(self, name):
+        '''returns a 1D iterable of data for Y axis
+
+        Args:
+            name: a column label, or an expression of column labels such
+                as "i0 * energy"'''
+
+        if name.startswith("log "):
+            return numpy.log(self.getYData(name.replace("log ", "", 1)))
+        data = self.getColumns().get_data(name=name)
+        if data is None:
+            raise ValueError("no channel called %s" % name)
+        return data
+
+    def readData(self, file, data=None):
+        '''parses file, unless data already holds its ColumnData'''
+
+        if data is None and not os.path.isfile(file):
+            raise IOError(2, "no such file", file)
+
+        if data is None:
+            if not self.sniff(self.readHead(file)):
+                raise FileTypeError(file)
+            data = CD.ColumnData(file)
+        if data.labels == []:
+            raise FileTypeError(file)
+        return data
@@ -19,14 +19,14 @@ class Data1DSheet(DataSheet):
             dest: something with a plot method
         '''
 
-        X = self.getXData(name=dataSrc["X"])
-        Y = self.getYData(name=dataSrc["Y"])
+        X, Y = self.getXYData(x=dataSrc["X"], y=dataSrc["Y"])
         name = self.getPlotName(x=dataSrc["X"], y=dataSrc["Y"])
 
         if kwargs.get("overplot", False):
             self.writeOut("Overplotting %s" % name)
             try:
                 dest.oplot(X, Y)
+                self.followPlot(dest, dataSrc, overplot=True)
             except AttributeError, e:
                 if e.message == "'PlotPanel' object has no attribute 'data_range'":
                     wx.MessageBox("cannot overplot before plotting. Will plot instead.")
@@ -36,6 +36,25 @@ class Data1DSheet(DataSheet):
         else:
             self.writeOut("Plotting %s" % name)
             dest.plot(X, Y)
+            self.followPlot(dest, dataSrc)
+
+    def followPlot(self, dest, dataSrc, overplot=False):
+        '''remembers which trace of dest shows dataSrc, for updatePlots'''
+
+        if not overplot:
+            self.followed = [f for f in self.followed if f[0] is not dest]
+        trace = len([f for f in self.followed if f[0] is dest])
+        self.followed.append((dest, trace, dataSrc))
+
+    def updatePlots(self):
+        '''pushes the current data into every trace plotted so far'''
+
+        alive = [self.plot] + self.plotframes
+        self.followed = [f for f in self.followed if f[0] in alive]
+        for dest, trace, dataSrc in self.followed:
+            X, Y = self.getXYData(x=dataSrc["X"], y=dataSrc["Y"])
+            dest.set_xylims([min(X), max(X), min(Y), max(Y)])
+            dest.update_line(trace, X, Y)
 
     def getDataChoice(self):
         '''returns something that can be passed as dataSrc argument to doPlot'''
@@ -60,7 +79,7 @@ class Data1DSheet(DataSheet):
             X=VarSelPanel(parent=self, var="X", sizer=self.ctrlsizer,
                 options=self.getXDataNames(), defchoice=-1),
             Y=VarSelPanel(parent=self, var="Y", sizer=self.ctrlsizer,
-                options=self.getYDataNames(), defchoice=-1),
+                options=self.getYDataNames(), defchoice=-1, editable=True),
             Plot=VarSelPanel(parent=self, var="Plot", sizer=self.ctrlsizer,
                 options=[], defchoicelabel="in"))
 
@@ -112,6 +131,13 @@ class Data1DSheet(DataSheet):
         return "Plot %s v. %s" % (x, y)
 
 
+    def getXYData(self, x, y):
+        '''returns the X and Y data to plot against each other
+
+        Override this where the X data depends on the Y choice.'''
+
+        return self.getXData(name=x), self.getYData(name=y)
+
     def getXData(self, name):
         raise NotImplementedError("getXData")
     def getXDataNames(self):
@@ -22,7 +22,7 @@ class Data2DSheet(DataSheet):
 
         self.ctrls = dict( 
             Data=VarSelPanel(parent=self, var="Data", sizer=self.ctrlsizer,
-                options=self.getDataNames(), defchoice=-1),
+                options=self.getDataNames(), defchoice=-1, editable=True),
             Plot=VarSelPanel(parent=self, var="Plot", sizer=self.ctrlsizer,
                 options=[], defchoicelabel="in"))
 
@@ -63,9 +63,19 @@ class Data2DSheet(DataSheet):
         '''
 
         self.writeOut("Plotting %s" % dataSrc)
-        data = self.getData(name=self.getPlotName())
+        data = self.getData(name=dataSrc)
         dest.display(data)
         dest.redraw()
+        self.followed = [f for f in self.followed if f[0] is not dest]
+        self.followed.append((dest, dataSrc))
+
+    def updatePlots(self):
+        '''pushes the current data into every image displayed so far'''
+
+        alive = [self.plot] + self.plotframes
+        self.followed = [f for f in self.followed if f[0] in alive]
+        for dest, dataSrc in self.followed:
+            dest.update_image(self.getData(name=dataSrc))
 
     def getDataChoice(self):
         '''returns something that can be passed as dataSrc argument to doPlot'''
@@ -21,11 +21,16 @@ class DataSheet(wx.Panel):
         writeOut: function that writes normal output to the right place
         writeErr: same for errors
         treeItem: its entry in the TreeCtrl nav bar
+        followed: plots to update when new data arrives, see mkFollowCtrl
         sizer
         no panel because it IS a panel!
     '''
 
     inPanelOpt, inNewFrameOpt = "In Panel", "New Plot"
+    followInterval = 2000 # milliseconds between polls of a followed file
+    sniffBytes = 16384 # how much of a file sniff looks at
+    priority = 0 # of all sheet types whose sniff accepts a file, the
+                 # one with the highest priority opens it
 
     def __init__(self, parent, **kwargs):
         '''Reads in the file and displays it.
@@ -33,6 +38,7 @@ class DataSheet(wx.Panel):
         Args:
             parent: parent window
             filename: name of data file
+            data: already-parsed contents of filename, if any
             treeitem: wx.TreeItemId of this sheet's entry in the left-hand nav
             writeOut: function that writes normal output to the right place
             writeErr: same for errors
@@ -49,20 +55,44 @@ class DataSheet(wx.Panel):
         for attr in ["filename", "parent", "treeItem", "writeOut", "writeErr", "plotframes"]:
             self.__setattr__(attr, kwargs.get(attr, defaults[attr]))
 
+        self.followed = []
+
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         self.SetSizer(self.sizer)
 
+        self.data = None
         try:
-            self.data = self.readData(file=self.filename)
+            self.data = self.readData(file=self.filename,
+                    data=kwargs.get("data", None))
         except FileTypeError, e:
             self.Destroy()
             raise e
+        self.Bind(event=wx.EVT_WINDOW_DESTROY, handler=self.onDestroy)
         self.mkCtrls()
         self.mkPanelPlot()
 
         self.sizer.SetSizeHints(self)
         self.Layout()
     
+    def onDestroy(self, event):
+        '''lets go of the data when the sheet is closed'''
+
+        if event.GetEventObject() is self:
+            self.releaseData()
+        event.Skip()
+
+    def releaseData(self):
+        '''called when the sheet is closed; override to free shared data'''
+
+        self.data = None
+
+    def getTreeChildren(self):
+        '''returns a list of (label, key) for entries to show under this
+        sheet in the tree, such as the scans of a multi-scan file. Picking
+        one calls selectTreeChild(key).'''
+
+        return []
+
     def onEvent(self, event):
         '''just pops up a MesssageBox announcing the event'''
         pass
@@ -132,7 +162,11 @@ class DataSheet(wx.Panel):
                     given: %s''' % e.message)
             return
 
-        self.doPlot(dataSrc, dest, **kwargs)
+        try: # can we make the data? typed-in expressions may be bad
+            self.doPlot(dataSrc, dest, **kwargs)
+        except ValueError, e:
+            wx.MessageBox("Cannot plot: %s" % e)
+            return
 
         # TODO: cruft to refactor
         destChoice = self.getCtrls("Plot")
@@ -155,6 +189,27 @@ class DataSheet(wx.Panel):
 
         print(s, file=sys.stderr)
 
+    @staticmethod
+    def readHead(path):
+        '''returns the first sniffBytes of path, for sniff; "" if path
+        cannot be read'''
+
+        try:
+            f = open(path, 'r')
+            head = f.read(DataSheet.sniffBytes)
+            f.close()
+        except (IOError, OSError):
+            head = ""
+        return head
+
+    @staticmethod
+    def sniff(head):
+        '''returns whether head, the first bytes of a file, looks like a
+        file this sheet type can open. Override with a cheap check: it is
+        tried on every file opened.'''
+
+        return False
+
     @staticmethod
     def isNewFrame(dest):
         return dest == DataSheet.inNewFrameOpt
@@ -177,6 +232,35 @@ class DataSheet(wx.Panel):
         self.updatePlotCtrl()
         pf.Destroy()
 
+    def mkFollowCtrl(self):
+        '''adds a "Follow" checkbox to self.ctrlsizer. While it is checked,
+        the file is polled for new data, which is pushed into the plots.'''
+
+        self.followbox = wx.CheckBox(parent=self, label="Follow")
+        self.followbox.Bind(event=wx.EVT_CHECKBOX, handler=self.onFollow)
+        self.ctrlsizer.AddF(item=self.followbox,
+                flags=wx.SizerFlags().Center().Border())
+
+        self.followtimer = wx.Timer(self)
+        self.Bind(event=wx.EVT_TIMER, handler=self.onFollowTimer,
+                source=self.followtimer)
+
+    def onFollow(self, event):
+        '''starts or stops polling the file for new data'''
+
+        if self.followbox.IsChecked():
+            self.followtimer.Start(DataSheet.followInterval)
+        else:
+            self.followtimer.Stop()
+
+    def onFollowTimer(self, event):
+        '''reads any new data and pushes it into the plots made so far'''
+
+        n = self.refreshData()
+        if n > 0:
+            self.writeOut("%s: %i new points" % (self.filename, n))
+            self.updatePlots()
+
     def updatePlotCtrl(self):
         '''discovers possible plotting destinations and updates the control.'''
 
@@ -185,7 +269,7 @@ class DataSheet(wx.Panel):
 
         self.plotctrl.setOptions(opts, defchoice=-1)
 
-    def readData(self, file):
+    def readData(self, file, data=None):
         raise NotImplementedError("readData")
     def getDataChoice(self):
         raise NotImplementedError("getDataChoice")
@@ -195,4 +279,10 @@ class DataSheet(wx.Panel):
         raise NotImplementedError("getPlotName")
     def mkNewFrame(self, name):
         raise NotImplementedError("mkNewFrame")
+    def refreshData(self):
+        raise NotImplementedError("refreshData")
+    def updatePlots(self):
+        raise NotImplementedError("updatePlots")
+    def selectTreeChild(self, key):
+        raise NotImplementedError("selectTreeChild")
 
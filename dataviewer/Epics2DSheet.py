@@ -6,27 +6,64 @@ from Exceptions import *
 
 class Epics2DSheet(Data2DSheet):
 
+    priority = 30
+
+    @staticmethod
+    def sniff(head):
+        '''an Epics scan header, of a 2D map'''
+
+        info = ED.probe_head(head)
+        return info["format"] == "escan" and info["dimension"] == 2
+
     def getData(self, name):
-        '''returns a 1D iterable of positioning data for X axis
+        '''returns a 2D array of data for the map
 
         Args:
-            name: a name from self.data.pos_names'''
+            name: a name from self.data.sums_names, or an expression of
+                channel names such as "(As_Ka + As_Kb) / I0"'''
 
-        return self.data.get_data(name=name)
+        data = self.data.get_data(name=name)
+        if data is None:
+            raise ValueError("no channel called %s" % name)
+        return data
 
     def getDataNames(self):
 
         return self.data.sums_names
 
-    def readData(self, file):
+    def mkCtrls(self):
+        '''adds a Follow checkbox to the usual controls'''
+
+        Data2DSheet.mkCtrls(self)
+        self.mkFollowCtrl()
+
+    def refreshData(self):
+        '''reads points appended to the file since the last read
 
-        if not os.path.isfile(file):
+        Returns: the number of new points'''
+
+        return self.data.refresh()
+
+    def readData(self, file, data=None):
+        '''parses file, unless data already holds its escan_data'''
+
+        if data is None and not os.path.isfile(file):
             raise IOError(2, "no such file", file)
 
-        rv = ED.escan_data(file=file)
+        # shared with any other sheet showing the same file
+        rv = ED.open_scan(file, data=data)
         # escan_data returns successfully regardless of whether it actually
         # opens the file or not, so we have to guess based on what comes back
         if rv.det_names != [] and rv.dimension == 2:
             return rv
-        else: raise FileTypeError(file)
+        else:
+            ED.release_scan(rv)
+            raise FileTypeError(file)
+
+    def releaseData(self):
+        '''gives the shared scan back to escan_data's registry'''
+
+        if self.data is not None:
+            ED.release_scan(self.data)
+            self.data = None
 
@@ -0,0 +1,99 @@
+import os
+import numpy
+
+from Data1DSheet import Data1DSheet
+import mca_data as MD
+from Exceptions import *
+
+class MCASheet(Data1DSheet):
+    '''Holds a multi-element MCA spectra file
+
+    Y can be the summed spectrum, with or without live time correction,
+    the spectrum of one element, or the counts in an ROI for each
+    element, which go with "Element" for X. A summed spectrum is given
+    on the common energy axis of the file, one element's spectrum on
+    that element's own energies and channels.'''
+
+    sumName, sumLTName = "Sum", "Sum / live time"
+    priority = 30
+
+    @staticmethod
+    def sniff(head):
+        '''the VERSION, ELEMENTS and CHANNELS lines of an MCA file'''
+
+        return MD.sniff(head)
+
+    def getXYData(self, x, y):
+        '''returns the X and Y data to plot against each other
+
+        "Energy" and "Channel" for X are those of the element when Y is the
+        spectrum of one element.'''
+
+        elem = y.replace("log ", "", 1)
+        if x in ("Energy", "Channel") and elem.startswith("Element "):
+            i = int(elem.split()[1]) - 1
+            if x == "Channel":
+                X = numpy.arange(self.data.nchan)
+            elif self.data.calibrated[i]:
+                X = self.data.energies[i]
+            else:
+                raise ValueError("element %i has no usable energy calibration"
+                                 % (i + 1))
+            return X, self.getYData(name=y)
+        return Data1DSheet.getXYData(self, x, y)
+
+    def getXData(self, name):
+        '''returns a 1D iterable of data for X axis, for summed spectra
+
+        Args:
+            name: "Energy", "Channel" or "Element"'''
+
+        if name == "Energy":
+            return self.data.energy
+        elif name == "Channel":
+            return self.data.channels
+        elif name == "Element":
+            return numpy.arange(1, self.data.nelem + 1)
+        raise ValueError("no X data called %s" % name)
+
+    def getXDataNames(self):
+
+        return ["Energy", "Channel", "Element"]
+
+    def getYDataNames(self):
+
+        names = [MCASheet.sumName, MCASheet.sumLTName]
+        names += ["Element %i" % (i+1) for i in range(self.data.nelem)]
+        names = sum([ [n, "log %s" % n] for n in names], [])
+        return names + ["ROI %s" % n for n in self.data.roi_names]
+
+    def getYData(self, name):
+        '''returns a 1D iterable of data for Y axis
+
+        Args:
+            name: a name from getYDataNames()'''
+
+        if name.startswith("log "):
+            return numpy.log(self.getYData(name.replace("log ", "", 1)))
+        elif name == MCASheet.sumName:
+            return self.data.get_spectrum()
+        elif name == MCASheet.sumLTName:
+            return self.data.get_spectrum(livetime_correct=True)
+        elif name.startswith("Element "):
+            return self.data.get_spectrum(elem=int(name.split()[1]) - 1)
+        elif name.startswith("ROI "):
+            i = self.data.roi_names.index(name[4:])
+            return self.data.get_roi_counts()[i]
+        raise ValueError("no Y data called %s" % name)
+
+    def readData(self, file, data=None):
+        '''parses file, unless data already holds its MCAData'''
+
+        if data is None and not os.path.isfile(file):
+            raise IOError(2, "no such file", file)
+
+        if data is None:
+            if not self.sniff(self.readHead(file)):
+                raise FileTypeError(file)
+            data = MD.MCAData(file)
+        return data
@@ -73,6 +73,10 @@ Matt Newville <newville@cars.uchicago.edu>"""
         """overwrite data for trace t """
         self.imagepanel.update_line(t,x,y,**kw)
 
+    def update_image(self,x):
+        """overwrite data of the displayed image """
+        self.imagepanel.update_image(x)
+
     def set_xylims(self,xylims,**kw):
         """overwrite data for trace t """
         self.imagepanel.set_xylims(xylims,**kw)
@@ -7,6 +7,7 @@ import sys
 import time
 import os
 import wx
+import numpy
 import matplotlib
 import matplotlib.cm as colormap
 
@@ -100,10 +101,12 @@ Matt Newville <newville@cars.uchicago.edu>"""
         if x is not None: self.data_range[:1] = [min(x),max(x)]
         if y is not None: self.data_range[2:] = [min(y),max(y)]
 
-        scale =  1.0*max(data.ravel())
+        # maps still being measured are padded with NaN
+        scale =  1.0*numpy.nanmax(data)
         d = data / scale
         cnf = self.conf
         c = self.axes.imshow(d,cmap=self.win_config.cmap, interpolation=self.win_config.interp)
+        self.image = c
 
 
         # c = self.axes.pcolor(d,cmap=colormap.jet) # , interpolation='nearest')
@@ -221,6 +224,11 @@ Matt Newville <newville@cars.uchicago.edu>"""
         self.cursor_mode = 'cursor'
         self.redraw()
 
+    def update_image(self,data):
+        """ replace the data of the displayed image, for faster redraw """
+        self.image.set_data(data / (1.0*numpy.nanmax(data)))
+        self.redraw()
+
     def clear(self):
         """ clear plot """
         self.axes.cla()
@@ -1,11 +1,52 @@
 import wx
 import sys
 import os
+import multiprocessing
+import cPickle
 
 from WxUtil import *
 from Exceptions import *
+from DataSheet import DataSheet
 from Epics1DSheet import Epics1DSheet
 from Epics2DSheet import Epics2DSheet
+from SpecSheet import SpecSheet
+from ColumnSheet import ColumnSheet
+from MCASheet import MCASheet
+import escan_data as ED
+
+# the DataSheet types a file may be opened with; see pickSheetType
+sheetTypes = [Epics1DSheet, Epics2DSheet, MCASheet, SpecSheet, ColumnSheet]
+
+def pickSheetType(path):
+    '''returns the one DataSheet type to open path with, or None.
+
+    The first bytes of path are read once and offered to the sniff of
+    each sheet type; of those that accept them, the one with the highest
+    priority wins.'''
+
+    head = DataSheet.readHead(path)
+    fits = [t for t in sheetTypes if t.sniff(head)]
+    if fits == []:
+        return None
+    return max(fits, key=lambda t: t.priority)
+
+def parseFile(path):
+    '''parses path; runs in a worker process of MainFrame.openDataSheets.
+
+    Returns:
+        (path, pickled data or None, error message or None). Files that
+        are not Epics scans come back unparsed, for openDataSheet.  The
+        data is pickled here, not by the pool, so that a failure to
+        pickle or unpickle it is reported like any other error; the
+        pool would drop the result without calling back.'''
+
+    try:
+        if pickSheetType(path) not in (Epics1DSheet, Epics2DSheet):
+            return (path, None, None)
+        data = ED.escan_data(file=path, message=None)
+        return (path, cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL), None)
+    except Exception, e:
+        return (path, None, "%s" % e)
 
 class Frame(wx.Frame):
     '''straight inherited from wx.Frame, but created in case I need to
@@ -22,6 +63,8 @@ class MainFrame(Frame):
         sizer: sizer for panel, holding nb
         nb: holds one data file per page
         datasheets: holds open DataSheets
+        loaders: worker pools still parsing files, with the number of
+            files each has left
         visibleDS: Datasheet shown in right pane
         statusbar
         menubar
@@ -36,6 +79,7 @@ class MainFrame(Frame):
         Frame.__init__(self, *args, **kwargs)
 
         self.datasheets = []
+        self.loaders = {}
 
         self.panel = wx.Panel(self)
         self.sizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -73,8 +117,12 @@ class MainFrame(Frame):
 
         ds = None
         if dlg.ShowModal() == wx.ID_OK:
-            for path in dlg.GetPaths():
-                ds = self.openDataSheet(path)
+            paths = dlg.GetPaths()
+            if len(paths) > 1:
+                self.openDataSheets(paths)
+            else:
+                for path in paths:
+                    ds = self.openDataSheet(path)
         dlg.Destroy()
 
         #if ds is not None and ds != self.splitW.GetWindow2():
@@ -85,12 +133,27 @@ class MainFrame(Frame):
         self.sizer.SetSizeHints(self)
         self.sizer.Layout()
 
+    def OnClickFileClose(self, event):
+        '''Event handler that closes the DataSheet shown in the right-hand
+        pane, releasing its data.'''
+
+        ds = self.visibleDS
+        if ds not in self.datasheets:
+            return
+
+        self.datasheets.remove(ds)
+        self.showRightPane(self.blankPanel)
+        self.tree.Delete(ds.treeItem)
+        ds.Destroy()
+
     def configMenuBar(self):
         '''returns suitable createMenuBar input for the desired menu bar'''
 
         filemenu = ("&File", [])
         filemenu[1].append(dict(id=-1, text="&Open", help="Open a data file",
             handler=self.OnClickFileOpen))
+        filemenu[1].append(dict(id=-1, text="&Close", help="Close the data file shown",
+            handler=self.OnClickFileClose))
 
         return [filemenu]
 
@@ -107,35 +170,102 @@ class MainFrame(Frame):
     def onTreeItemActivated(self, event):
         '''when user clicks on a DataSheet's item in the tree, show that DataSheet.'''
 
-        self.showRightPane(self.tree.GetItemPyData(event.GetItem()))
+        item = event.GetItem()
+        if not item.IsOk() or self.tree.GetItemPyData(item) is None:
+            return
+        ds = self.tree.GetItemPyData(item)
+        if isinstance(ds, tuple): # an entry listed under a DataSheet
+            ds, key = ds
+            ds.selectTreeChild(key)
+        if ds is not self.visibleDS:
+            self.showRightPane(ds)
         self.sizer.SetSizeHints(self)
         self.Layout()
 
-    def openDataSheet(self, path):
-        '''identifies the filetype, creates the DataSheet, adds it to the tree, and shows it.'''
+    def openDataSheets(self, paths):
+        '''parses paths at the same time in a pool of worker processes.
+
+        Each DataSheet is added to the tree as soon as its file has been
+        parsed, so sheets appear in completion order, not in the order
+        given.'''
+
+        paths = [p for p in paths if self.checkPath(p)]
+        if paths == []:
+            return
+
+        pool = multiprocessing.Pool(processes=min(len(paths),
+            multiprocessing.cpu_count()))
+        self.loaders[pool] = len(paths)
+        for path in paths:
+            pool.apply_async(parseFile, (path,),
+                callback=lambda rv, pool=pool: wx.CallAfter(self.onFileParsed, pool, *rv))
+        pool.close()
+        self.statusbar.SetStatusText("loading %i files" % len(paths), 0)
+
+    def onFileParsed(self, pool, path, data, err):
+        '''called on the GUI thread when a worker has finished parsing path.'''
+
+        if data is not None:
+            try:
+                data = cPickle.loads(data)
+            except Exception, e:
+                data, err = None, "%s" % e
+
+        if err is not None:
+            self.statusbar.SetStatusText("could not read %s: %s" % (path, err), 0)
+        else:
+            self.openDataSheet(path, data=data)
+
+        self.loaders[pool] -= 1
+        if self.loaders[pool] == 0:
+            del self.loaders[pool]
+            pool.join()
+
+        self.sizer.SetSizeHints(self)
+        self.sizer.Layout()
+
+    def checkPath(self, path):
+        '''returns whether path is an existing file, telling the user if not.'''
 
-        # TODO this should be pushed down into the DataSheet constructor
         if not os.path.isfile(path):
             wx.MessageBox(caption="File not found", 
                     message="file %s not found, not opened." % path)
+            return False
+        return True
+
+    def openDataSheet(self, path, data=None):
+        '''identifies the filetype, creates the DataSheet, adds it to the tree, and shows it.
+
+        Args:
+            path: name of data file
+            data: already-parsed contents of path, if any'''
+
+        # TODO this should be pushed down into the DataSheet constructor
+        if not self.checkPath(path):
             return
 
         item=self.tree.AppendItem(parent=self.tree.GetRootItem(), 
                 text=os.path.basename(path))
         self.tree.Fit()
 
+        # sniff the first bytes to pick the one sheet type that fits, so
+        # the file is parsed only once
+        filetype = pickSheetType(path)
+
         ds = None
-        for filetype in [Epics1DSheet, Epics2DSheet]:
+        if filetype is not None:
             try:
-                ds = filetype(parent=self.splitW, filename=path, treeItem=item,
+                ds = filetype(parent=self.splitW, filename=path, data=data, treeItem=item,
                         writeOut=lambda s: self.statusbar.SetStatusText(s, 0),
                         writeErr=lambda s: self.statusbar.SetStatusText(s, 0))
-                break;
             except FileTypeError:
                 pass
         if ds is not None:
             self.datasheets.append(ds)
             self.tree.SetItemPyData(item=item, obj=ds)
+            for label, key in ds.getTreeChildren():
+                child = self.tree.AppendItem(parent=item, text=label)
+                self.tree.SetItemPyData(item=child, obj=(ds, key))
             self.tree.SelectItem(item=item)
         else:
             self.tree.Delete(item)
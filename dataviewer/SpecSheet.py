@@ -0,0 +1,58 @@
+import os
+
+from ColumnSheet import ColumnSheet
+import spec_data as SD
+from Exceptions import *
+
+class SpecSheet(ColumnSheet):
+    '''Holds a SPEC file of many scans
+
+    The scans are listed under the file's entry in the tree; the X and Y
+    controls offer the columns of the scan picked there. A scan is only
+    parsed when it is first picked.
+
+    Attributes:
+        scan: the SpecScan shown
+    '''
+
+    priority = 20 # SPEC files are column files too: take them first
+
+    @staticmethod
+    def sniff(head):
+        '''SPEC '#' control lines'''
+
+        return SD.sniff(head)
+
+    def getColumns(self):
+        '''returns the scan shown'''
+
+        return self.scan
+
+    def getTreeChildren(self):
+        '''returns (label, key) of each scan, for entries in the tree'''
+
+        return [ ("#%s  %s" % (number, title), i)
+                for i, (number, title) in enumerate(self.data.get_scan_list())]
+
+    def selectTreeChild(self, key):
+        '''shows the scan at position key in the file'''
+
+        self.scan = self.data.get_scan(key)
+        self.ctrls["X"].setOptions(self.getXDataNames())
+        self.ctrls["Y"].setOptions(self.getYDataNames())
+        self.writeOut("scan #%s: %s" % (self.scan.number, self.scan.title))
+
+    def readData(self, file, data=None):
+        '''indexes the scans of file, unless data already holds its SpecFile'''
+
+        if data is None and not os.path.isfile(file):
+            raise IOError(2, "no such file", file)
+
+        if data is None:
+            if not self.sniff(self.readHead(file)):
+                raise FileTypeError(file)
+            data = SD.SpecFile(file)
+        if len(data) == 0:
+            raise FileTypeError(file)
+        self.scan = data.get_scan(0)
+        return data
@@ -16,6 +16,7 @@ class VarSelPanel(wx.Panel):
         defchoice:  None means no default
                     non-None in options means use that option
                     non-None not in options means use first option
+        editable: if True, the user may also type in a value
         sizer
     '''
 
@@ -26,7 +27,8 @@ class VarSelPanel(wx.Panel):
 
         # print(options, file=sys.stderr)
 
-        dk = dict(sizerFlags=wx.SizerFlags().Border(), label="%s =" % var)
+        dk = dict(sizerFlags=wx.SizerFlags().Border(), label="%s =" % var,
+                editable=False)
         dk.update(**kwargs)
 
         if 'defchoice' in kwargs:
@@ -41,12 +43,18 @@ class VarSelPanel(wx.Panel):
         self.label = wx.StaticText(parent=self, label=dk['label'])
         self.sizer.AddF(item=self.label, flags=wx.SizerFlags().Center().Border())
 
-        self.dropdown = wx.ComboBox(parent=self, style=wx.CB_READONLY,
+        style = wx.CB_READONLY
+        if dk['editable']:
+            style = wx.CB_DROPDOWN
+        self.dropdown = wx.ComboBox(parent=self, style=style,
                 choices=options)
         if 'defchoice' in kwargs:
             self.dropdown.SetValue(self.selection)
         self.Bind(event=wx.EVT_COMBOBOX, handler=self.onEvtComboBox, 
                 source=self.dropdown)
+        if dk['editable']:
+            self.Bind(event=wx.EVT_TEXT, handler=self.onEvtComboBox,
+                    source=self.dropdown)
         self.sizer.AddF(item=self.dropdown, flags=wx.SizerFlags(1).Center())
 
         self.sizer.SetSizeHints(self)
@@ -0,0 +1,188 @@
+"""
+channel expressions: arithmetic on named data channels
+
+an expression such as "(As_Ka + As_Kb) / I0", "log(I0/I1)" or "d/dx(Fe)"
+is compiled once into a tree of nested tuples:
+    ('num', value)             a constant
+    ('chan', name)             a data channel
+    (op, arg1, arg2, ...)      an operator or function applied to subtrees
+Equal subexpressions give equal (hashable) subtrees, so a memo keyed on the
+subtree shares their results between expressions.
+
+Channel names are identifiers, with '_' standing in for spaces, or quoted
+strings for names that are not identifiers:  'mca1: As Ka' / I0
+"""
+import ast
+import re
+import numpy
+
+class ExpressionError(ValueError):
+    pass
+
+# functions that may be used in expressions; ddx (written d/dx) needs the
+# abscissa, so the caller supplies it to evaluate()
+functions = {'log': numpy.log, 'ln': numpy.log, 'log10': numpy.log10,
+             'exp': numpy.exp, 'sqrt': numpy.sqrt, 'abs': numpy.abs,
+             'sin': numpy.sin, 'cos': numpy.cos, 'tan': numpy.tan}
+
+_binops = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/',
+           ast.Pow: '**'}
+_ops = {'+': numpy.add, '-': numpy.subtract, '*': numpy.multiply,
+        '/': numpy.true_divide, '**': numpy.power, 'neg': numpy.negative}
+
+_ddx = re.compile(r'\bd\s*/\s*dx\s*\(')
+_compiled = {}
+
+def is_expression(text):
+    "whether text looks like an expression rather than a channel name"
+    return re.search(r"[-+*/()'\"]", text) is not None
+
+def compile_expr(text):
+    """return the expression tree for text
+
+    trees are cached, so each expression is only parsed once"""
+    tree = _compiled.get(text, None)
+    if tree is None:
+        source = _ddx.sub('ddx(', text.strip())
+        try:
+            body = ast.parse(source, mode='eval').body
+        except SyntaxError:
+            raise ExpressionError("cannot parse expression '%s'" % text)
+        tree = _compiled[text] = _convert(body, text)
+    return tree
+
+def _convert(node, text):
+    "convert a python ast node into an expression tree"
+    if isinstance(node, ast.Num):
+        return ('num', float(node.n))
+    elif isinstance(node, ast.Str):
+        return ('chan', node.s)
+    elif isinstance(node, ast.Name):
+        return ('chan', node.id)
+    elif isinstance(node, ast.BinOp) and type(node.op) in _binops:
+        tree = (_binops[type(node.op)], _convert(node.left, text),
+                _convert(node.right, text))
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+        return _convert(node.operand, text)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        tree = ('neg', _convert(node.operand, text))
+    elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+          and (node.func.id in functions or node.func.id == 'ddx')
+          and len(node.args) == 1 and not node.keywords):
+        tree = (node.func.id, _convert(node.args[0], text))
+    else:
+        raise ExpressionError("unsupported syntax in expression '%s'" % text)
+    # fold constant subexpressions
+    if tree[0] != 'ddx' and all(arg[0] == 'num' for arg in tree[1:]):
+        return ('num', float(_apply(tree[0], [arg[1] for arg in tree[1:]])))
+    return tree
+
+def _apply(op, args):
+    if op in _ops:
+        return _ops[op](*args)
+    return functions[op](*args)
+
+def channels(tree):
+    "the set of channel names used in an expression tree"
+    if tree[0] == 'num':
+        return set()
+    elif tree[0] == 'chan':
+        return set([tree[1]])
+    return set().union(*[channels(arg) for arg in tree[1:]])
+
+def evaluate(tree, channel, ddx=None, memo=None):
+    """evaluate an expression tree
+
+    channel(name) returns the data array for a channel name, and ddx(arr)
+    the derivative of arr with respect to the abscissa.  memo(tree, calc),
+    if given, returns the result of calc() for an operator subtree,
+    caching it as it sees fit."""
+    kind = tree[0]
+    if kind == 'num':
+        return tree[1]
+    elif kind == 'chan':
+        return channel(tree[1])
+
+    def calc():
+        args = [evaluate(arg, channel, ddx=ddx, memo=memo)
+                for arg in tree[1:]]
+        if kind == 'ddx':
+            if ddx is None:
+                raise ExpressionError("d/dx is not available here")
+            return ddx(*args)
+        return _apply(kind, args)
+    if memo is None:
+        return calc()
+    return memo(tree, calc)
+
+def find_name(names, name):
+    "position of name in the list names, ignoring case, or None"
+    names = [n.lower() for n in names]
+    if name.lower() in names:
+        return names.index(name.lower())
+    return None
+
+def lookup(name, find, fetch, ddx=None, memo=None):
+    """data for a channel name, or an expression of channel names
+
+    find(name) returns a handle for the channel called name, or None, and
+    fetch(handle) its data.  Names in an expression are looked up as
+    given, then with '_' read as spaces.  Returns None for an unknown
+    channel name; an unknown name in an expression raises ExpressionError.
+    ddx and memo are passed on to evaluate()."""
+    found = find(name)
+    if found is None and is_expression(name):
+        tree = compile_expr(name)
+        def channel(cname):
+            found = find(cname)
+            if found is None:
+                found = find(cname.replace('_', ' '))
+            if found is None:
+                raise ExpressionError(
+                    "unknown channel '%s' in '%s'" % (cname, name))
+            return fetch(found)
+        return evaluate(tree, channel, ddx=ddx, memo=memo)
+    if found is None:
+        return None
+    return fetch(found)
+
+def get_data(getarray, name, norm=None, getnorm=None):
+    """getarray(name), divided by getnorm(norm) if norm is given
+
+    getarray looks up a channel name or expression, as lookup() does;
+    getnorm defaults to getarray.  An unknown name gives None, an
+    unknown norm a ValueError."""
+    dat = getarray(name)
+    if dat is None: return None
+    if norm is not None:
+        if getnorm is None: getnorm = getarray
+        normdat = getnorm(norm)
+        if normdat is None:
+            raise ValueError("unknown channel '%s' for norm" % norm)
+        # true division: channels may be stored as integer counts
+        dat = numpy.true_divide(dat, normdat)
+    return dat
+
+class Columns:
+    """channel lookup for data kept as named columns
+
+    mix in to a class with labels, a list of column names, and data, a
+    (ncol, npts) array with one row per column."""
+    def _find_channel(self, name):
+        "row of the column named name (ignoring case), or None"
+        return find_name(self.labels, name)
+
+    def _getarray(self, name):
+        return lookup(name, self._find_channel, self.data.__getitem__,
+                      ddx=self._ddx)
+
+    def _ddx(self, arr):
+        "derivative of arr with respect to the first column"
+        x = self.data[0]
+        arr = numpy.broadcast_to(arr, x.shape)
+        return numpy.gradient(arr)/numpy.gradient(x)
+
+    def get_data(self, name, norm=None):
+        """return the column called name (or an expression of column
+        names), divided by column norm if given"""
+        return get_data(self._getarray, name, norm)
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+"""
+reader for plain column data files, such as XMU files
+
+the file is a block of '#' comment lines followed by whitespace-separated
+columns of numbers.  Comment lines of the form '#% key: value' are
+metadata, and the last comment line names the columns:
+
+    #%atom: Cr
+    #%edge: K
+    #---------------
+    # energy     log(i0/it)   log(it/ir)  i0
+      5759.989   3.477293    2.05645     155472.8
+      ...
+
+The numeric body is converted in a single numpy call.
+"""
+import re
+import numpy
+
+import channel_expr
+from escan_data import _parse_rows
+
+def _is_number_line(line):
+    "whether line holds only numbers"
+    try:
+        [float(w) for w in line.split()]
+    except ValueError:
+        return False
+    return len(line.split()) > 0
+
+def sniff(head):
+    """whether head, the first bytes of a file, is a block of '#'
+    comment lines followed by a line of numbers"""
+    lines = head.splitlines()
+    if not head.endswith('\n') and len(lines) > 1:
+        lines.pop()          # probably cut short
+    if len(lines) == 0 or not lines[0].startswith('#'):
+        return False
+    for line in lines:
+        if not line.strip():
+            continue
+        if not line.startswith('#'):
+            return _is_number_line(line)
+    return False
+
+class ColumnData(channel_expr.Columns):
+    """ a column data file
+
+    attributes:
+        filename
+        labels:  column names, from the last comment line
+        info:    dict of the '#% key: value' metadata
+        header:  all the comment lines
+        data:    (ncol, npts) array, one row per column
+    """
+    def __init__(self, fname):
+        self.filename = fname
+        self.labels = []
+        self.info   = {}
+        self.header = []
+        self.data   = numpy.zeros((0, 0))
+        self.read_file(fname)
+
+    def read_file(self, fname):
+        f = open(fname, 'r')
+        text = f.read()
+        f.close()
+        # the comment block ends at the first line not starting with '#'
+        m = re.search(r'^(?!#)[ \t]*\S', text, re.M)
+        body = len(text)
+        if m is not None: body = m.start()
+        self.header = [l.strip() for l in text[:body].splitlines()
+                       if l.startswith('#')]
+        for line in self.header:
+            if line.startswith('#%') and ':' in line:
+                key, val = line[2:].split(':', 1)
+                self.info[key.strip()] = val.strip()
+
+        text = text[body:].strip()
+        if not text:
+            return
+        ncol  = len(text.split('\n', 1)[0].split())
+        nrows = text.count('\n') + 1
+        self.data = _parse_rows(text, nrows, ncol).transpose()
+
+        labels = []
+        if self.header:
+            labels = self.header[-1][1:].split()
+        if len(labels) != ncol:
+            labels = ['col%i' % (i+1) for i in range(ncol)]
+        self.labels = labels
@@ -2,9 +2,14 @@
 
 import os
 import sys
-import copy
 import time
 import json
+import mmap
+import re
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from collections import OrderedDict
 try:
     import numpy 
 except ImportError:
@@ -16,18 +21,565 @@ try:
     has_h5 = True
 except ImportError:
     has_h5 = False
-has_h5 = False
+
+import channel_expr
+
+# parsed scans are cached as HDF5 files in cache_dir, keyed on the data
+# file's path, size, mtime and cache_version.  Bump cache_version whenever
+# the parsed layout changes, so stale entries are never read back.  The
+# least recently used entries are removed once the cache holds more than
+# cache_maxbytes.  The full XRF spectra memmaps (.xrf) kept there too are
+# counted against xrf_cache_maxbytes instead, as one map alone can be
+# larger than all the parsed scans.
+cache_dir      = os.environ.get('ESCAN_CACHE_DIR',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.escan_cache'))
+cache_maxbytes = 2*1024**3
+xrf_cache_maxbytes = 16*1024**3
+cache_version  = '2.3.0'
+
+# full XRF spectra are kept as raw counts of this type in a memmap
+xrf_dtype = numpy.uint32
+
+def _h5value(dset):
+    "value of an h5py scalar or array dataset, with strings as str"
+    val = dset[()]
+    if isinstance(val, bytes) and not isinstance(val, str):
+        val = val.decode('utf-8')
+    return val
+
+def _h5value_attr(obj, name):
+    "value of an h5py attribute, with strings as str"
+    val = obj.attrs[name]
+    if isinstance(val, bytes) and not isinstance(val, str):
+        val = val.decode('utf-8')
+    return val
+
+def _h5view(dset, fname):
+    """read-only memmap onto the data of an h5py dataset in file fname,
+    or None if the dataset is chunked or compressed and cannot be mapped"""
+    if dset.chunks is not None or dset.size == 0:
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:
+        return None
+    return numpy.memmap(fname, dtype=dset.dtype, mode='r', offset=offset,
+                        shape=dset.shape)
+
+def cache_name(fname, suffix='.h5'):
+    """name of the cache file for the current contents of fname
+
+    the key covers the full path, size and mtime of the data file (and of
+    its .fullxrf companion, if any) and the cache format version, hashed
+    as bytes.  Returns None if no key can be made for fname, in which
+    case it is simply not cached."""
+    key = [cache_version, os.path.abspath(fname)]
+    try:
+        for f in (fname, "%s.fullxrf" % fname):
+            if os.path.exists(f):
+                st = os.stat(f)
+                key.extend([f, repr(st.st_size), repr(st.st_mtime)])
+        key = [k.encode('utf-8') if isinstance(k, unicode) else k
+               for k in key]
+    except (OSError, UnicodeError):
+        return None
+    digest = hashlib.sha1('|'.join(key)).hexdigest()
+    return os.path.join(cache_dir, "%s%s" % (digest, suffix))
+
+@contextmanager
+def atomic_write(fname):
+    """context for writing the file fname atomically: it gives a
+    temporary name in the same directory to write to, which replaces
+    fname when the block ends, or is removed if it raises.  Readers never
+    see a partial file.  Anything holding the temporary file open must
+    be closed by the end of the block."""
+    dirname = os.path.dirname(fname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+    os.close(fd)
+    try:
+        yield tmpname
+        if os.name == 'nt' and os.path.exists(fname):
+            os.unlink(fname)
+        os.rename(tmpname, fname)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+
+def clean_cache(maxbytes=None, xrf_maxbytes=None, keep=()):
+    """remove least recently used cache files until the parsed scans
+    total below maxbytes and the XRF spectra memmaps below xrf_maxbytes
+
+    the files named in keep, such as one just written, are never removed,
+    even if they alone are over the limit"""
+    if maxbytes is None: maxbytes = cache_maxbytes
+    if xrf_maxbytes is None: xrf_maxbytes = xrf_cache_maxbytes
+    keep = [os.path.abspath(f) for f in keep]
+    _trim_cache(('.h5', '.json'), maxbytes, keep)
+    _trim_cache(('.xrf',), xrf_maxbytes, keep)
+
+def _trim_cache(extensions, maxbytes, keep):
+    "clean_cache() for the cache files with the given extensions"
+    try:
+        names = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)
+                 if f.endswith(extensions)]
+    except OSError:
+        return
+    entries = []
+    for f in names:
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, f))
+    entries.sort()
+    total = sum([e[1] for e in entries])
+    for mtime, size, f in entries:
+        if total <= maxbytes: break
+        if os.path.abspath(f) in keep: continue
+        try:
+            os.unlink(f)
+            total = total - size
+        except OSError:
+            pass
+
+def probe(fname, nbytes=16384):
+    """take a cheap look at the first nbytes of fname, without parsing it
+
+    Returns: dict with keys
+        format:     'escan', or None if fname is not an Epics Scan file
+        dimension:  1 or 2
+        ncolumns:   number of data columns (positioners + detectors)
+        npoints:    number of data points, estimated from the file size
+                    and the length of the data lines seen (0 if none)
+    """
+    try:
+        f = open(fname, 'r')
+        head = f.read(nbytes)
+        size = os.fstat(f.fileno()).st_size
+        f.close()
+    except (IOError, OSError):
+        head, size = '', 0
+    return probe_head(head, size)
+
+def probe_head(head, size=None):
+    """probe() on head, the first bytes of a file of size bytes
+
+    npoints is 0 if size is not given"""
+    out = {'format': None, 'dimension': 1, 'ncolumns': 0, 'npoints': 0}
+    lines = head.splitlines(True)
+    if len(lines) == 0 or 'Epics Scan' not in lines[0]:
+        return out
+    out['format'] = 'escan'
+    if (size is None or len(head) < size) and len(lines) > 1:
+        lines.pop()          # probably cut short
+    nlabels = 0
+    ndata, data_start, data_bytes = 0, None, 0
+    pos = 0
+    for line in lines:
+        if line[:1] in (';', '#'):
+            s = line[1:].strip()
+            if s.lower().startswith('2d'):
+                out['dimension'] = 2
+            elif s.lower().startswith('scan dimension'):
+                try:
+                    out['dimension'] = int(float(s.split('=')[1]))
+                except (IndexError, ValueError):
+                    pass
+            elif re.match(r'[PD]\d+\s*=', s):
+                nlabels += 1
+        elif _is_dataline(line):
+            if data_start is None:
+                data_start = pos
+                out['ncolumns'] = len(line.split())
+            ndata += 1
+            data_bytes += len(line)
+        pos += len(line)
+    if nlabels > 0:
+        out['ncolumns'] = nlabels
+    if ndata > 0 and size is not None:
+        out['npoints'] = int((size - data_start) * ndata / data_bytes)
+    return out
+
+def _is_dataline(line):
+    "is line a row of numeric column data?"
+    if line is None or len(line) < 3 or line[0] in (';', '#'):
+        return False
+    try:
+        float(line.split()[0])
+    except (ValueError, IndexError):
+        return False
+    return True
+
+def _parse_rows(text, nrows, ncol, dtype=float, usecols=None, warn=None):
+    """convert text holding nrows lines of ncol numbers each to a
+    (nrows, ncol) array of dtype, or (nrows, len(usecols)) if usecols
+    lists the columns to keep
+
+    the text is handed to numpy in one call; if the count does not come
+    out even (a blank or short line, say) the rows are converted one at a
+    time and those with the wrong number of columns are dropped, with a
+    warning passed to warn, or printed if warn is None"""
+    dat = numpy.fromstring(text, dtype=dtype, sep=' ')
+    if dat.size == ncol*nrows:
+        dat.shape = (nrows, ncol)
+    else:
+        rows = [r.split() for r in text.splitlines()]
+        rows = [r for r in rows if len(r) > 0]
+        dat  = [[float(i) for i in r] for r in rows if len(r) == ncol]
+        dat  = numpy.array(dat, dtype=dtype).reshape((len(dat), ncol))
+        ndrop = len(rows) - len(dat)
+        if ndrop > 0:
+            msg = 'Warning: %i ragged data rows dropped' % ndrop
+            if warn is None:
+                print msg
+            else:
+                warn(msg)
+    if usecols is not None:
+        dat = dat[:, usecols]
+    return dat
+
+class _RowBuffer:
+    """ growable (npts, ncol) float array, filled one block of rows at a time
+
+    rows are stored row-major, exactly as they come out of the text, so
+    appending a parsed block is a single slice assignment.  The buffer
+    grows geometrically, so the number of copies stays small even when
+    the initial size hint is poor.
+    """
+    def __init__(self, ncol, size=1024):
+        self.data = numpy.empty((max(size, 1), ncol))
+        self.npts = 0
+
+    def __len__(self):
+        return self.npts
+
+    def append(self, rows):
+        "append a (nrows, ncol) array of rows"
+        nnew = self.npts + rows.shape[0]
+        if nnew > self.data.shape[0]:
+            grown = numpy.empty((max(nnew, 2*self.data.shape[0]),
+                                 self.data.shape[1]))
+            grown[:self.npts] = self.data[:self.npts]
+            self.data = grown
+        self.data[self.npts:nnew] = rows
+        self.npts = nnew
+
+    def finish(self):
+        "release unused rows and return the (npts, ncol) array"
+        self.data.resize((self.npts, self.data.shape[1]), refcheck=False)
+        return self.data
+
+class _LineReader:
+    """ forward-only line reader over an open file, with one line of lookahead
+
+    lines are pulled from the file in chunks of about bufsize bytes by a
+    generator, so only one chunk of raw text is held at a time.  pop()
+    returns the next line, peek() shows it without consuming it, and
+    nbytes is the file position reached, for progress reporting.  tail
+    holds the last line consumed if it had no newline (it may still be
+    being written), and is empty otherwise.
+    """
+    blocklines = 1<<16
+
+    def __init__(self, fh, bufsize=1<<20):
+        self.fh     = fh
+        self.size   = os.fstat(fh.fileno()).st_size
+        self.nbytes = fh.tell()
+        self.tail   = ''
+        self._lines = self._readlines(bufsize)
+        self._next  = next(self._lines, None)
+
+    def _readlines(self, bufsize):
+        while True:
+            chunk = self.fh.readlines(bufsize)
+            if not chunk: break
+            for line in chunk:
+                yield line
+        self.fh.close()
+
+    def __nonzero__(self):
+        return self._next is not None
+    __bool__ = __nonzero__
+
+    def peek(self):
+        "return the next line without consuming it, None at end of file"
+        return self._next
+
+    def pop(self):
+        "return the next line"
+        line = self._next
+        if line is None:
+            raise IndexError('pop past end of file')
+        self._next = next(self._lines, None)
+        self.nbytes += len(line)
+        self.tail = ''
+        if not line.endswith('\n'): self.tail = line
+        return line
+
+    def read_block(self, ncol, usecols=None, warn=None):
+        """read the contiguous data lines ahead, return a (nrows, ncol)
+        array, keeping only the columns in usecols if given.  warn is
+        passed on to _parse_rows.
+
+        lines are converted blocklines at a time, so a long data region
+        is never held as one full-width array.  An unterminated last line
+        without ncol values is left unread."""
+        out, block = [], []
+        while (self._next is not None and len(self._next) > 2 and
+               self._next[0] not in (';', '#')):
+            if (not self._next.endswith('\n') and
+                len(self._next.split()) != ncol):
+                break
+            block.append(self.pop())
+            if len(block) >= self.blocklines:
+                out.append(_parse_rows(''.join(block), len(block), ncol,
+                                       usecols=usecols, warn=warn))
+                block = []
+        if block or not out:
+            out.append(_parse_rows(''.join(block), len(block), ncol,
+                                   usecols=usecols, warn=warn))
+        if len(out) == 1:
+            return out[0]
+        return numpy.concatenate(out)
+
+    def close(self):
+        self._next = None
+        self.fh.close()
+
+class _MappedReader:
+    """ line reader over a memory-mapped file
+
+    has the same pop()/peek()/read_block() interface as _LineReader, but
+    the file is never read into Python strings line by line: comment
+    lines are located by scanning the mapped bytes for newlines, and
+    each data region (everything up to the next ';' or '#' line) is
+    handed to numpy straight from the map, chunk by chunk.  Only the
+    parsed arrays need to stay resident.
+    """
+    chunksize = 1<<24
+
+    def __init__(self, fh):
+        self.fh     = fh
+        self.size   = os.fstat(fh.fileno()).st_size
+        self.mm     = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.nbytes = 0
+        self.tail   = ''
+        self._marks = {}
+
+    def __nonzero__(self):
+        return self.nbytes < self.size
+    __bool__ = __nonzero__
+
+    def _find(self, sub, start, end=None):
+        "position of sub in the map, or the end of the search range"
+        if end is None: end = self.size
+        i = self.mm.find(sub, start, end)
+        if i < 0: return end
+        return i
+
+    def _find_mark(self, sub):
+        """position of the next sub from nbytes on, or the end of the file
+
+        the position found is kept and reused until nbytes passes it, so
+        looking for the end of each data region does not search the rest
+        of the file again every time"""
+        pos = self._marks.get(sub, -1)
+        if pos < self.nbytes:
+            pos = self._marks[sub] = self._find(sub, self.nbytes)
+        return pos
+
+    def peek(self):
+        "return the next line without consuming it, None at end of file"
+        if self.nbytes >= self.size:
+            return None
+        return self.mm[self.nbytes:self._find('\n', self.nbytes) + 1]
+
+    def pop(self):
+        "return the next line"
+        line = self.peek()
+        if line is None:
+            raise IndexError('pop past end of file')
+        self.nbytes += len(line)
+        self.tail = ''
+        if not line.endswith('\n'): self.tail = line
+        return line
+
+    def read_block(self, ncol, usecols=None, warn=None):
+        """parse the data region ahead, return a (nrows, ncol) array,
+        keeping only the columns in usecols if given.  An unterminated
+        last line without ncol values is left unread.  warn is passed on
+        to _parse_rows."""
+        end  = min(self._find_mark('\n;'), self._find_mark('\n#'))
+        end  = min(end + 1, self.size)
+        if end == self.size and self.mm[end-1:end] != '\n':
+            last = self.mm.rfind('\n', self.nbytes, end) + 1
+            if last > self.nbytes and len(self.mm[last:end].split()) != ncol:
+                end = last
+        out  = []
+        while self.nbytes < end:
+            # split the region on line boundaries into chunksize pieces
+            stop = end
+            if end - self.nbytes > self.chunksize:
+                stop = self.mm.rfind('\n', self.nbytes,
+                                     self.nbytes + self.chunksize) + 1
+                if stop <= self.nbytes: stop = end
+            text  = self.mm[self.nbytes:stop]
+            # blank lines before the next comment line are not rows
+            nrows = text.rstrip().count('\n') + 1
+            out.append(_parse_rows(text, nrows, ncol, usecols=usecols,
+                                   warn=warn))
+            self.nbytes = stop
+            self.tail = text[text.rfind('\n')+1:]
+        if len(out) == 1:
+            return out[0]
+        return numpy.concatenate(out)
+
+    def close(self):
+        self.nbytes = self.size
+        self.mm.close()
+        self.fh.close()
+
+class _ParseState:
+    """ how far read_ascii got through a file, so refresh() can carry on """
+    def __init__(self):
+        self.mode         = None
+        self.tmp_dat      = None   # _RowBuffer of data rows
+        self.tmp_y        = []
+        self.col_details  = []
+        self.col_legend   = None
+        self.ncol         = 0      # columns of a data row, from the legend
+        self.usecols      = None   # data columns kept, for a projection
+        self.row_starts   = []     # first point of each map row (2d)
+        self.offset       = 0      # file position parsed up to
+        self.tail         = 0      # bytes of an unterminated last line
+        self.tail_rows    = 0      # rows parsed from that line
+        self.npos         = 0
+        self.npts         = 0      # points in the arrays
+        self.nx           = 0      # points per map row (2d)
+        self.finished     = False  # a second scan was found: stop here
+
+def _owned_nbytes(arrays):
+    """bytes held by the arrays that own their data, counting each once:
+    views of other arrays cost nothing extra"""
+    seen = {}
+    for arr in arrays:
+        if isinstance(arr, numpy.ndarray) and arr.base is None:
+            seen[id(arr)] = arr.nbytes
+    return sum(seen.values())
+
+def iocr_index(det_names):
+    """for each (label, pvname) in det_names, the row of iocr holding the
+    dead-time correction for that detector: the mca number of an mca
+    channel, less one, or -1 for detectors that are not corrected"""
+    index = []
+    for label, pvname in det_names:
+        if 'mca' in pvname:
+            index.append(int(pvname.split('mca')[1].split('.')[0]) - 1)
+        else:
+            index.append(-1)
+    return numpy.array(index, dtype=int)
+
+def _map_index(row_starts, g0, g1, nx):
+    """return (index, keep) placing points g0 to g1 of a 2d scan in its
+    map: index gives the flat (row-major) map position of each point that
+    fits in a row of nx points, keep which points those are"""
+    g = numpy.arange(g0, g1)
+    starts = numpy.array(row_starts, dtype=int)
+    row = numpy.searchsorted(starts, g, side='right') - 1
+    col = g - starts[row]
+    keep = (row >= 0) & (col < nx)
+    return (row*nx + col)[keep], keep
+
+def _row_length(row_starts, npts):
+    "the length of the longest row of a 2d scan of npts points"
+    if len(row_starts) == 0:
+        return 0
+    return int(numpy.diff(list(row_starts) + [npts]).max())
+
+def _members_index(members):
+    """index for the rows of the detectors in members: a slice if they
+    are adjacent and in order, else the list"""
+    if members == range(members[0], members[-1]+1):
+        return slice(members[0], members[-1]+1)
+    return members
+
+def _set_rows(arr, rows, n, store=None):
+    """return arr with rows (a dict of index: row) replaced and grown to
+    n rows, changed in place when it can be
+
+    store, if given, converts the new rows to the storage type; if they
+    no longer fit an integer arr, arr is converted to their float type"""
+    if store is not None and len(rows) > 0:
+        new = store(numpy.array(rows.values()), counts=True)
+        if arr.dtype.kind in 'ui' and new.dtype.kind == 'f':
+            arr = arr.astype(new.dtype)
+    if n > len(arr) or not arr.flags.writeable:
+        grown = numpy.zeros((n,) + arr.shape[1:], dtype=arr.dtype)
+        grown[:len(arr)] = arr
+        arr = grown
+    for i, row in rows.items():
+        arr[i] = row
+    return arr
+
+def _extend(full, view, new, n):
+    """return (full, view) with new appended to the first n entries of
+    view along axis 1
+
+    full is the backing array of view, with spare room along axis 1; it is
+    only replaced (by one twice the size) when the room runs out, so
+    appending a few points at a time costs amortized O(1) per point."""
+    m = n + new.shape[1]
+    if full is None or view.base is not full or m > full.shape[1]:
+        shape = list(new.shape)
+        shape[1] = max(m, 2*n)
+        grown = numpy.empty(shape, dtype=view.dtype)
+        grown[:, :n] = view[:, :n]
+        full = grown
+    full[:, n:m] = new
+    return full, full[:, :m]
 
 class escan_data:
     """ Epics Scan Data """
+    xrf_chunksize = 1<<25   # bytes of .fullxrf text parsed per chunk
+    derived_maxbytes = 1<<28  # budget for corrected (derived) arrays
     mode_names = ('2d', 'epics scan',
                   'user titles', 'pv list',
                   '-----','=====',
                   'scan began at', 'scan ended at',
                   'column labels', 'scan regions','data')
     
-    def __init__(self,file='',correct_deadtime=True,**args):
+    def __init__(self,file='',correct_deadtime=True,use_mmap=False,
+                 use_cache=True,dtype=None,cache_views=False,columns=None,
+                 **args):
+        """dtype sets how pos, det, sums and the corrected arrays are
+        stored: None for float64, a smaller float type such as 'float32',
+        or 'counts' to keep det and sums as uint32 when they hold whole
+        counts (and float32 otherwise).  With cache_views, arrays read
+        from the parse cache are read-only memmaps onto the cache file
+        rather than private copies; they use a cache entry of their own,
+        written uncompressed.
+
+        columns, a list of positioner, detector or sum names, reads only
+        those channels from the file (with the first positioner, and the
+        ICR/OCR channels needed to correct mca detectors): every data
+        line is still split, but only the chosen columns are kept.  Such
+        partial reads are not cached."""
+        if isinstance(dtype, str) and dtype == 'counts':
+            pass
+        elif dtype is not None:
+            dtype = numpy.dtype(dtype)
+            if dtype.kind != 'f':
+                raise ValueError("dtype must be a float type or 'counts'")
+            if dtype == numpy.dtype(float):
+                dtype = None
         self.filename    = file
+        self.use_mmap    = use_mmap
+        self.use_cache   = use_cache and has_h5 and columns is None
+        self.columns     = columns
+        self.dtype       = dtype
+        self.cache_views = cache_views
         self.xpos        = ''
         self.ypos        = ''
         self.start_time  = ''
@@ -46,10 +598,13 @@ class escan_data:
         self.sums_names = []
         self.sums_list  = []
         self.iocr       = None
+        self._corr_index = None
+        self._name_index = None
 
         self.has_fullxrf = False
         self.xrf_data = []
         self.xrf_energies = []
+        self._xrf_index = None
         self.xrf_header = ''
         
         self.correct_deadtime = correct_deadtime
@@ -62,9 +617,43 @@ class escan_data:
         
         self.x = numpy.array(0)
         self.y = numpy.array(0)
+        self._state = None
+        self._cached_stat = None   # (size, mtime) of a file read from cache
+        self._full  = {}
+        self._derived = OrderedDict()
+        self.data_hits   = 0
+        self.data_misses = 0
+        self.readonly = False
         if self.filename != '':
             self.read_data_file(fname=self.filename)
 
+    def __getstate__(self):
+        "pickle support: a full XRF memmap is re-opened, not copied"
+        state = self.__dict__.copy()
+        state['_derived'] = OrderedDict()
+        state['_xrf_index'] = None
+        if isinstance(self.xrf_data, numpy.memmap):
+            state['xrf_data'] = (self.xrf_data.filename,
+                                 self.xrf_data.shape)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.xrf_data, tuple):
+            mapname, shape = self.xrf_data
+            self.xrf_data = numpy.memmap(mapname, dtype=xrf_dtype,
+                                         mode='r', shape=shape)
+
+    def __getattr__(self, name):
+        "det_corr and sums_corr are only computed when first asked for"
+        if name == 'det_corr':
+            if self.iocr is None: return self.det
+            return self._get_derived('det_corr', self._calc_det_corr)
+        elif name == 'sums_corr':
+            if self.iocr is None: return self.sums
+            return self._get_derived('sums_corr', self._calc_sums_corr)
+        raise AttributeError(name)
+
     def message_printer(self,s,val):
         sys.stdout.write("%s\n" % val)
 
@@ -94,36 +683,77 @@ class escan_data:
         return self.get_data(name=name,norm=norm)
 
     def get_data(self,name=None,norm=None,icr_correct=True):
-        """return data array by name"""
-        dat = self._getarray(name,icr_correct=icr_correct)
-        if dat is None: return data
-        if norm is not None:
-            norm = self._getarray(norm,icr_correct=True)
-            dat  = dat/norm            
+        """return data array by name
+
+        name and norm may also be expressions of channel names, such as
+        "(As_Ka + As_Kb) / I0", see channel_expr.  An unknown name gives
+        None, an unknown norm a ValueError.  Results are kept with
+        the derived arrays until the scan is refreshed or regrouped;
+        data_hits and data_misses count how often they were reused.  As
+        they are shared, the arrays returned are read-only: copy them to
+        change them."""
+        key = ('get_data', name, norm, icr_correct)
+        if key in self._derived:
+            self.data_hits += 1
+        else:
+            self.data_misses += 1
+        return self._get_derived(key, lambda: self._calc_data(name, norm,
+                                                              icr_correct))
+
+    def _calc_data(self, name, norm, icr_correct):
+        def getarray(cname):
+            return self._getarray(cname, icr_correct=icr_correct)
+        dat = channel_expr.get_data(getarray, name, norm,
+                                     getnorm=self._getarray)
+        if isinstance(dat, numpy.ndarray):
+            dat.flags.writeable = False
         return dat
     
     def match_detector_name(self, s, strict=False):
         """return index in self.det_names most closely matching supplied string"""
         s  = s.lower()
         sw = s.split()
-        b  = [i[0].lower() for i in self.det_names]
+        if len(sw) == 0: return -1
+        index = self._get_name_index()
         # look for exact match
-        for i in b:
-            if (s == i):  return b.index(i)
-        
+        if s in index['exact']:   return index['exact'][s]
+
         # look for inexact match 1: compare 1st words
-        for i in b:
-            sx = i.split()
-            if (sw[0] == sx[0]):   return b.index(i)
+        if sw[0] in index['first']:  return index['first'][sw[0]]
 
         # check for 1st word in the det name
-        if not strict:
-            for i in b:
-                j = i.find(sw[0])
-                if (j >= 0):  return b.index(i)
+        if not strict and sw[0] in index['substring']:
+            return index['substring'][sw[0]]
         # found no matches
         return -1
 
+    def _get_name_index(self):
+        """return lookup tables for channel names, built once for the
+        current detector lists
+
+        'exact', 'first' and 'substring' map a lowercased detector name,
+        its first word, and any substring of it to the first detector
+        matching that way, for match_detector_name.  'channels' maps the
+        lowercased names of sums, detectors and positioners to (kind,
+        index), for _find_channel."""
+        if self._name_index is None:
+            index = dict(exact={}, first={}, substring={}, channels={})
+            for i, det in enumerate(self.det_names):
+                name = det[0].lower()
+                index['exact'].setdefault(name, i)
+                if len(name.split()) > 0:
+                    index['first'].setdefault(name.split()[0], i)
+                for j in range(len(name)):
+                    for k in range(j+1, len(name)+1):
+                        index['substring'].setdefault(name[j:k], i)
+            for kind, names in (('sums', self.sums_names),
+                                ('det', [d[0] for d in self.det_names]),
+                                ('pos', [p[0] for p in self.pos_names])):
+                for i, name in enumerate(names):
+                    index['channels'].setdefault(name.lower(), (kind, i))
+            self._name_index = index
+        return self._name_index
+
     def ShowProgress(self,val,row=-1):
         if (self.progress != None):
             self.progress(val)
@@ -140,43 +770,71 @@ class escan_data:
         sys.stdout.flush()
         
     def read_data_file(self,fname=None):
-        """generic data file reader"""
+        """generic data file reader
+
+        uses the parse cache in cache_dir when self.use_cache is set:
+        a cached copy of an unchanged file is read back instead of
+        re-parsing the ASCII, and a fresh parse is added to the cache."""
         if fname is None: fname = self.filename
-        h5name = "%s.h5" % fname
-        read_ascii = True
-        if has_h5 and os.path.exists(h5name):
-            mtime_ascii = os.stat(fname)[8]
-            mtime_h5    = os.stat(h5name)[8]
-            if mtime_h5 > mtime_ascii:
+        h5name = None
+        if self.use_cache and os.path.exists(fname):
+            suffix = ''
+            if self.dtype is not None:
+                # arrays are cached as stored
+                suffix = '-%s' % getattr(self.dtype, 'name', self.dtype)
+            if self.cache_views:
+                # and uncompressed, so they can be mapped
+                suffix = suffix + '-views'
+            h5name = cache_name(fname, suffix=suffix + '.h5')
+        if h5name is not None and os.path.exists(h5name):
+            try:
+                st = os.stat(fname)
+                self._cached_stat = (st.st_size, st.st_mtime)
                 retval = self.read_h5file(h5name)
-                if retval is None:
-                    msg = "file %s read OK" % h5name
-                    self.ShowMessage(msg)
-                    read_ascii = False
-
-        if read_ascii:
-            retval = self.read_ascii(fname=fname)
+            except Exception:
+                retval = -1
             if retval is None:
-                msg = "file %s read OK" % fname
-            else:
-                msg = "problem reading file %s" % fname
-            self.ShowMessage(msg)
-            if has_h5 and retval is None:
+                # mark as recently used for clean_cache()
                 try:
-                    self.write_h5file(h5name)
-                except:
-                    if os.path.exists(h5name):
-                        os.unlink(h5name)
+                    os.utime(h5name, None)
+                except OSError:
+                    pass
+                self.ShowMessage("file %s read OK (cached)" % fname)
+                if os.path.exists("%s.fullxrf" % fname):
+                    self.read_fullxrf("%s.fullxrf" % fname,
+                                      len(self.x), len(self.y))
+                return retval
+
+        retval = self.read_ascii(fname=fname)
+        if retval is None:
+            msg = "file %s read OK" % fname
+        else:
+            msg = "problem reading file %s" % fname
+        self.ShowMessage(msg)
+        if h5name is not None and retval is None:
+            try:
+                self.write_cache(h5name)
+            except Exception:
+                print 'Warning: could not write cache file for %s' % fname
         return retval
 
-    def write_h5file(self,h5name):
-        try:
-            fout = h5py.File(h5name, 'w')
-        except:
-            print 'write_h5file error??? ', h5name
-            
+    def write_cache(self,h5name):
+        """write the parsed scan to h5name atomically, then trim the cache
+
+        Full XRF spectra are left out: they have their own memmap."""
+        with atomic_write(h5name) as tmpname:
+            self.write_h5file(tmpname, fullxrf=False)
+        clean_cache(keep=[h5name] + self._mapped_files())
 
-        fout.attrs['Version'] = '1.0.0'
+    def _mapped_files(self):
+        "names of the cache files this scan has memmaps onto"
+        return [arr.filename for arr in (self.xrf_data, self._xrf_index)
+                if isinstance(arr, numpy.memmap) and arr.filename]
+
+    def write_h5file(self,h5name,fullxrf=True):
+        fout = h5py.File(h5name, 'w')
+
+        fout.attrs['Version'] = cache_version
         fout.attrs['Title'] = 'Epics Scan Data'
         fout.attrs['Beamline'] = 'GSECARS / APS'
 
@@ -197,19 +855,23 @@ class escan_data:
         g['correct_deadtime'] = repr(self.correct_deadtime)
         attr_list = ['det', 'pos', 'sums']
         if self.iocr is not None:
-            attr_list.extend(['iocr', 'det_corr', 'sums_corr'])
-        else:
-            g['iocr'] = 'False'
-        
+            # corrected arrays are cheap to derive again from iocr
+            attr_list.append('iocr')
+
+        # cache_views maps these straight from the file, so they must
+        # be stored contiguous and uncompressed
+        compression = 5
+        if self.cache_views: compression = None
         for attr in attr_list:
-            g.create_dataset(attr, data= getattr(self,attr), compression=5)
+            g.create_dataset(attr, data= getattr(self,attr),
+                             compression=compression)
 
         for attr in ('pos_names', 'det_names', 'pv_list',
                      'scan_regions', 'user_titles', 'info',
                      'sums_list', 'sums_names'):
             g[attr] = json.dumps(getattr(self,attr))
 
-        if self.has_fullxrf:
+        if self.has_fullxrf and fullxrf:
             g = fout.create_group('full_xrf')
             g['header'] = self.xrf_header
             g.create_dataset('data', data= self.xrf_data, compression=5)
@@ -222,95 +884,199 @@ class escan_data:
     def read_h5file(self,h5name):
         f = h5py.File(h5name,'r')
 
-        isValid = False
-        attrs  = f.attrs
         try:
-            version = f.attrs['Version']
-            title   = f.attrs['Title']
-            if title  != 'Epics Scan Data': raise KeyError
-            beamline = f.attrs['Beamline']
-            isValid = True
+            version = _h5value_attr(f, 'Version')
+            title   = _h5value_attr(f, 'Title')
         except KeyError:
-            isValid = False
-        if not isValid:
-            raise
+            version = title = None
+        if title != 'Epics Scan Data' or version != cache_version:
+            f.close()
+            return -1
 
         g = f['scan']
-        self.stop_time  = g['stop_time'].value
-        self.start_time = g['start_time'].value
-        self.dimension  = g['dimension'].value
+        self.stop_time  = _h5value(g['stop_time'])
+        self.start_time = _h5value(g['start_time'])
+        self.dimension  = int(_h5value(g['dimension']))
 
-        self.x    = g['x'].value
-        self.xpos = g['x'].attrs['name']
+        self.x    = _h5value(g['x'])
+        self.xpos = _h5value_attr(g['x'], 'name')
         self.y    = []
         self.ypos = ''
         if self.dimension > 1:
-            self.y = g['y'].value
-            self.ypos = g['y'].attrs['name']
-
-        self.correct_deadtime = g['correct_deadtime'].value == 'True'
-        if g['iocr'].value == 'False':
-            self.iocr = None
-            self.det_corr = []
-            self.sums_corr = []
-            
-        attr_list = ['det', 'pos', 'sums']
-        if self.iocr is not None:
-            attr_list.extend(['iocr', 'det_corr', 'sums_corr'])
-
-        for attr in attr_list:
-            setattr(self,attr,  g[attr].value)
+            self.y = _h5value(g['y'])
+            self.ypos = _h5value_attr(g['y'], 'name')
+
+        self.correct_deadtime = _h5value(g['correct_deadtime']) == 'True'
+        self.iocr = None
+        for attr in ('det', 'pos', 'sums', 'iocr'):
+            if attr not in g: continue
+            arr = None
+            if self.cache_views:
+                arr = _h5view(g[attr], h5name)
+            if arr is None:
+                arr = _h5value(g[attr])
+            setattr(self, attr, arr)
+        self._derived.clear()
 
         for attr in ('pos_names', 'det_names', 'pv_list',
                      'scan_regions', 'user_titles', 'info',
                      'sums_list', 'sums_names'):
-            setattr(self,attr, json.loads(g[attr].value))
-        
-        self.has_fullxrf = 'full_xrf' in f.keys()
+            setattr(self,attr, json.loads(_h5value(g[attr])))
+        self.pos_names = [tuple(i) for i in self.pos_names]
+        self.det_names = [tuple(i) for i in self.det_names]
+        self._corr_index = None
+        self._name_index = None
+
+        self.has_fullxrf = 'full_xrf' in f
         if self.has_fullxrf:
             g = f['full_xrf']
-            self.xrf_header = g['header'].value
-            self.xrf_energies = g['energies'].value
-            self.xrf_data = g['data'] .value
+            self.xrf_header = _h5value(g['header'])
+            self.xrf_energies = _h5value(g['energies'])
+            self.xrf_data = _h5value(g['data'])
+            self._xrf_index = None
         f.close()
         return None
         
     def _getarray(self,name=None,icr_correct=True):
-        i = None
-        arr = None
         if name in self.sums_names:
-            i = self.sums_names.index(name)
-            arr = self.sums
-            if icr_correct: arr = self.sums_corr
-        else:
-            i = self.match_detector_name(name)
-            arr = self.det
-            if icr_correct: arr = self.det_corr
-        if i is not None:
-            return arr[i]
-        
-        return None
+            return self._channel_array('sums', self.sums_names.index(name),
+                                       icr_correct)
+        if (channel_expr.is_expression(name) and
+            self._find_channel(name) is None):
+            return self._get_expression(name, icr_correct)
+        i = self.match_detector_name(name)
+        if i < 0:
+            return None
+        return self._channel_array('det', i, icr_correct)
+
+    def _find_channel(self, name):
+        """return (kind, index) of the sum, detector or positioner named
+        exactly name (ignoring case), or None"""
+        return self._get_name_index()['channels'].get(name.lower(), None)
+
+    def _channel_array(self, kind, i, icr_correct=True):
+        "data for channel i of kind 'sums', 'det' or 'pos'"
+        if kind == 'pos':
+            return self.pos[i]
+        if icr_correct and self.iocr is not None:
+            return self._get_derived(('%s_corr' % kind, i),
+                                     lambda: self._calc_corr(i, kind == 'sums'))
+        return getattr(self, kind)[i]
+
+    def _get_expression(self, text, icr_correct=True):
+        """evaluate a channel expression, with its operator subexpressions
+        kept in the derived cache"""
+        def fetch(found):
+            return self._channel_array(found[0], found[1], icr_correct)
+        def memo(tree, calc):
+            return self._get_derived(('expr', icr_correct, tree), calc)
+        return channel_expr.lookup(text, self._find_channel, fetch,
+                                   ddx=self._ddx, memo=memo)
+
+    def _ddx(self, arr):
+        "derivative of arr with respect to the first positioner"
+        x = self.pos[0]
+        arr = numpy.broadcast_to(arr, x.shape)
+        return numpy.gradient(arr, axis=-1)/numpy.gradient(x, axis=-1)
+
+    def _get_derived(self, key, calc):
+        """return the derived array for key, computing it with calc() if
+        it is not in the derived cache
+
+        the cache is kept within derived_maxbytes by dropping the least
+        recently used arrays, which are simply computed again if asked
+        for later"""
+        if key in self._derived:
+            arr = self._derived[key] = self._derived.pop(key)
+            return arr
+        arr = calc()
+        if self.readonly and isinstance(arr, numpy.ndarray):
+            arr.flags.writeable = False
+        self._derived[key] = arr
+        while (len(self._derived) > 1 and
+               _owned_nbytes(self._derived.values()) > self.derived_maxbytes):
+            self._derived.popitem(last=False)
+        return arr
+
+    def _float_dtype(self):
+        "the type of iocr and the corrected arrays"
+        if self.dtype is None:
+            return numpy.dtype(float)
+        elif isinstance(self.dtype, str):
+            return numpy.dtype(numpy.float32)
+        return self.dtype
+
+    def _store(self, arr, counts=False):
+        """arr converted to the storage type set by self.dtype
+
+        with dtype 'counts', arrays of counts (det and sums) are kept as
+        uint32 if all their values are whole numbers that fit"""
+        if arr is None or self.dtype is None:
+            return arr
+        if isinstance(self.dtype, str) and counts:
+            if arr.size == 0 or (arr.min() >= 0 and arr.max() < 2**32 and
+                                 (arr == numpy.floor(arr)).all()):
+                return arr.astype(numpy.uint32, order='C')
+        return arr.astype(self._float_dtype(), order='C')
+
+    def _calc_scale(self):
+        "iocr, with a row of ones for detectors that are not corrected"
+        iocr = self.iocr
+        scale = numpy.vstack((iocr, numpy.ones((1,) + iocr.shape[1:])))
+        return scale.astype(self._float_dtype(), copy=False)
+
+    def _calc_corr(self, i, sums=False):
+        "icr/ocr corrected data for detector i, or for sum i"
+        index = self._get_corr_index()[0]
+        members = [i]
+        if sums: members = self._sum_members(i)
+        if len(members) == 0:
+            return numpy.zeros(self.det.shape[1:], dtype=self._float_dtype())
+        sel = _members_index(members)
+        if 'det_corr' in self._derived:
+            return self.det_corr[sel].sum(axis=0)
+        scale = self._get_derived('scale', self._calc_scale)
+        corr  = (self.det[sel] * scale.take(index[sel], axis=0)).sum(axis=0)
+        return corr.astype(self._float_dtype(), copy=False)
+
+    def _calc_det_corr(self):
+        "icr/ocr corrected data for all detectors"
+        index = self._get_corr_index()[0]
+        scale = self._get_derived('scale', self._calc_scale)
+        # gathered straight into its own array and scaled in place
+        det_corr = numpy.empty(self.det.shape, dtype=scale.dtype)
+        numpy.take(scale, index, axis=0, out=det_corr)
+        det_corr *= self.det
+        return det_corr
+
+    def _calc_sums_corr(self):
+        "icr/ocr corrected sums of detectors"
+        return self._group_sums(self.det_corr)
         
                 
     def _open_ascii(self,fname=None):
-        """open ascii file, return lines after some checking"""
+        """open ascii file, return a line reader after some checking
+
+        the reader is a _MappedReader if self.use_mmap is set, and a
+        streaming _LineReader otherwise"""
         if fname is None: fname = self.filename
         if fname is None: return None
 
         self.ShowProgress(1.0)
         self.ShowMessage("opening file %s  ... " % fname)
         try:
-            f = open(fname,'r')
-            lines = f.readlines()
-            lines.reverse()
-            f.close()
+            if self.use_mmap:
+                lines = _MappedReader(open(fname,'rb'))
+            else:
+                lines = _LineReader(open(fname,'r'))
+            line1 = lines.pop()
         except:
             self.ShowMessage("ERROR: general error reading file %s " % fname)
             return None
 
-        line1    = lines.pop()
         if 'Epics Scan' not in line1:
             self.ShowMessage("Error: %s is not an Epics Scan file" % fname)
+            lines.close()
             return None
         return lines
         
@@ -336,36 +1102,16 @@ class escan_data:
         return (mode, inp)
         
 
-    def _make_arrays(self, tmp_dat, col_legend, col_details):
-        # convert tmp_dat to numpy 2d array
-        dat = numpy.array(tmp_dat).transpose()
-        print 'dat: ', dat.shape
-        # make raw position and detector data, using column labels
-        npos = len( [i for i in col_legend if i.lower().startswith('p')])
-        ndet = len( [i for i in col_legend if i.lower().startswith('d')])
-
-        self.pos  = dat[0:npos,:]
-        self.det  = dat[npos:,:]
+    def _group_detectors(self):
+        """make sums of detectors with same name and isolate icr / ocr
 
-        # parse detector labels
-        for i in col_details:
-            try:
-                key,detail = i.split('=')
-            except:
-                break
-            label,pvname = [i.strip() for i in detail.split('-->')]
-            label = label[1:-1]
-            if key.startswith('P'):
-                self.pos_names.append((label,pvname))
-            else:
-                self.det_names.append((label,pvname))                
-                
-        # make sums of detectors with same name and isolate icr / ocr
-        self.sums       = []
+        sets sums_names, sums_list and self._icr, self._ocr, the rows of
+        the raw detector data holding ICR and OCR"""
         self.sums_names = []
         self.sums_list  = []
-        self.iocr       = None
-        icr,ocr = [],[]
+        self._icr, self._ocr = [], []
+        self._corr_index = None
+        self._name_index = None
         sum_name = None
         isum = -1
         for i, det in enumerate(self.det_names):
@@ -376,115 +1122,289 @@ class escan_data:
                 sum_name = thisname
                 self.sums_names.append(sum_name)
                 isum  = isum + 1
-                self.sums.append( self.det[i][:] )
                 self.sums_list.append(i)
                 o = [i]
             else:
-                self.sums[isum] += self.det[i][:]
                 o.append(i)
                 self.sums_list[isum] = o
-            if 'icr' in thisname.lower(): icr.append(self.det[i][:])
-            if 'ocr' in thisname.lower(): ocr.append(self.det[i][:])
+            if 'icr' in thisname.lower(): self._icr.append(i)
+            if 'ocr' in thisname.lower(): self._ocr.append(i)
 
-        self.sums = numpy.array(self.sums)
         # if icr/ocr data is included, pop them from
         # the detector lists.
         self.info['icr/ocr'] = False
-        if len(icr)>0 and len(ocr)==len(icr):
-            self.iocr  = numpy.array(icr)/numpy.array(ocr)
-            n_icr     = self.iocr.shape[0]
-            self.det  = self.det[0:-2*n_icr]
-            self.sums = self.sums[0:-2*n_icr]
+        if len(self._icr)>0 and len(self._ocr)==len(self._icr):
+            n_icr = len(self._icr)
             self.sums_list  = self.sums_list[:-2*n_icr]
             self.sums_names = self.sums_names[:-2*n_icr]
             self.det_names  = self.det_names[:-2*n_icr]
             self.info['icr/ocr'] = True
-            
+
+    def _get_corr_index(self):
+        """return (iocr_index, perm, starts, nonempty) for the current
+        detector lists
+
+        iocr_index gives, for each detector, the row of iocr (as extended
+        by a row of ones) that corrects it: detectors that are not mca
+        channels get -1, the ones row.  The others describe the sums as a
+        single numpy.add.reduceat: perm orders the detectors by sum (None
+        when they already are), starts gives where each sum begins in that
+        order, and nonempty which sums have any detectors (None if all)."""
+        if self._corr_index is None:
+            index = iocr_index(self.det_names)
+            perm, starts, nonempty = [], [], []
+            for i in range(len(self.sums_list)):
+                members = self._sum_members(i)
+                if len(members) > 0:
+                    starts.append(len(perm))
+                    nonempty.append(i)
+                    perm.extend(members)
+            if perm == range(len(self.det_names)):
+                perm = None
+            else:
+                perm = numpy.array(perm, dtype=int)
+            if len(nonempty) == len(self.sums_list):
+                nonempty = None
+            self._corr_index = (index, perm,
+                                numpy.array(starts, dtype=int), nonempty)
+        return self._corr_index
+
+    def _sum_members(self, i):
+        "list of the detectors added up in sum i"
+        members = self.sums_list[i]
+        if isinstance(members, (list, tuple)):
+            return list(members)
+        return [members]
+
+    def _group_sums(self, det):
+        """the sums of the rows of det, grouped as in sums_list"""
+        index, perm, starts, nonempty = self._get_corr_index()
+        if len(starts) == 0:
+            return numpy.zeros((len(self.sums_list),) + det.shape[1:],
+                               dtype=det.dtype)
+        if perm is not None:
+            det = det.take(perm, axis=0)
+        sums = numpy.add.reduceat(det, starts, axis=0)
+        if nonempty is not None:
+            # sums left without detectors are zero
+            full = numpy.zeros((len(self.sums_list),) + sums.shape[1:],
+                               dtype=sums.dtype)
+            full[nonempty] = sums
+            sums = full
+        return sums
+
+    def _derive(self, det):
+        """return det, sums, iocr for the raw detector columns det (one row
+        per detector, including icr/ocr)
+
+        the icr/ocr corrected arrays are derived from these when needed"""
+        iocr = None
+        if self.info['icr/ocr']:
+            iocr = det[self._icr]/det[self._ocr]
+            det  = det[:-2*len(self._icr)]
+        sums = self._group_sums(det)
+        return (self._store(det, counts=True), self._store(sums, counts=True),
+                self._store(iocr))
+
+    def _select_columns(self, state):
+        """return the data columns to keep for self.columns, trimming
+        state.col_legend and state.col_details to match
+
+        a column is kept if its label, or its sum name ('As Ka' for
+        'mca2: As Ka'), is one of the requested names.  The first
+        positioner is always kept, and if any mca detector is, so are all
+        the ICR/OCR columns, which come last in the file."""
+        wanted  = set(c.lower() for c in self.columns)
+        details = {}
+        for line in state.col_details[1:]:
+            try:
+                key,detail = line.split('=')
+            except:
+                break
+            label,pvname = [i.strip() for i in detail.split('-->')]
+            details[key.strip()] = (line, label[1:-1], pvname)
+
+        keep, iocr, need_iocr, found = [], [], False, set()
+        for icol, key in enumerate(state.col_legend):
+            raw, label, pvname = details.get(key, (None, key, ''))
+            name = label
+            if 'mca' in label and ':' in label:
+                name = label.replace('mca','').split(':')[1].strip()
+            if not key.lower().startswith('p') and (
+                'icr' in name.lower() or 'ocr' in name.lower()):
+                iocr.append(icol)
+            elif icol == 0 or label.lower() in wanted or name.lower() in wanted:
+                keep.append(icol)
+                found.update((label.lower(), name.lower()))
+                if 'mca' in label and ':' in label: need_iocr = True
+        for name in wanted - found:
+            print 'Warning: no column named %s' % name
+        if need_iocr: keep.extend(iocr)
+
+        legend = state.col_legend
+        state.col_legend  = [legend[i] for i in keep]
+        state.col_details = state.col_details[:1] + [
+            details[legend[i]][0] for i in keep if legend[i] in details]
+        return keep
+
+    def _make_arrays(self, tmp_dat, col_legend, col_details):
+        # tmp_dat is a (npts, ncol) array: columns become rows here
+        dat = tmp_dat.transpose()
+        # make raw position and detector data, using column labels
+        npos = len( [i for i in col_legend if i.lower().startswith('p')])
+        ndet = len( [i for i in col_legend if i.lower().startswith('d')])
+
+        # parse detector labels
+        for i in col_details:
+            try:
+                key,detail = i.split('=')
+            except:
+                break
+            label,pvname = [i.strip() for i in detail.split('-->')]
+            label = label[1:-1]
+            if key.startswith('P'):
+                self.pos_names.append((label,pvname))
+            else:
+                self.det_names.append((label,pvname))                
+
+        self._group_detectors()
+        self._full = {}
+        self._derived.clear()
+        self.pos = self._store(dat[0:npos,:])
+        self.det, self.sums, self.iocr = self._derive(dat[npos:,:])
+
         if self.dimension == 2:
             ny = len(self.y)
-            nx = len(tmp_dat)/ny
-            # print self.det.shape, ny, len(tmp_dat), len(tmp_dat)*1.0/ny
-            self.det.shape   = (self.det.shape[0],  ny, nx)
-            self.pos.shape  = (self.pos.shape[0],  ny, nx)
-            self.sums.shape = (self.sums.shape[0], ny, nx)
-            if self.iocr is not None:
-                self.iocr.shape = (self.iocr.shape[0], ny, nx)
-           
-            self.x = self.pos[0,0,:]
+            nx = dat.shape[1]/ny
+            for attr in ('pos', 'det', 'sums', 'iocr'):
+                arr = getattr(self, attr)
+                if arr is not None:
+                    arr.shape = (arr.shape[0], ny, nx)
+            self.x = self._map_x()
         else:
             self.x = self.pos[0]
             nx = len(self.x)
             self.y = []
-
-        # finally, icr/ocr corrected sums
-        self.det_corr  = copy.deepcopy(self.det)
-        self.sums_corr = copy.deepcopy(self.sums)
-
-        if self.info['icr/ocr']:
-            idet = -1
-            for label,pvname in self.det_names:
-                idet = idet + 1
-                if 'mca' in pvname:
-                    nmca = int(pvname.split('mca')[1].split('.')[0]) -1
-                    self.det_corr[idet] *=  self.iocr[nmca]
-
-            isum = -1
-            for sumlist in self.sums_list:
-                isum  = isum + 1
-                if isinstance(sumlist, (list,tuple)):
-                    self.sums_corr[isum] = self.det_corr[sumlist[0]]
-                    for i in sumlist[1:]:
-                        self.sums_corr[isum] += self.det_corr[i]                
-
-                else:
-                    self.sums_corr[isum] = self.det_corr[sumlist]
-
         return
-        
-    def read_ascii(self,fname=None):
-        """read ascii data file"""
-        lines = self._open_ascii(fname=fname)
-        if lines is None: return -1
-        
-        maxlines = len(lines)
-
-        iline = 1
-        ndata_points = None
-        tmp_dat = []
-        tmp_y   = []
-        col_details = []
-        col_legend = None
-        ntotal_at_2d = []
-        mode = None
+
+    def _nominal_axes(self):
+        """return the nominal positions (x, y) of the scan, from its scan
+        regions: the first block of regions gives the inner (x) scan and a
+        second block, if there is one, the outer (y) scan.  Positions that
+        cannot be worked out are None."""
+        blocks, block = [], None
+        for line in self.scan_regions:
+            try:
+                start, stop, step = [float(w) for w in line.split()[:3]]
+            except ValueError:  # a title line, starting a new block
+                block = None
+                continue
+            if block is None:
+                block = []
+                blocks.append(block)
+            block.append((start, stop, step))
+        axes = [None, None]
+        for i, block in enumerate(blocks[:2]):
+            vals = []
+            for start, stop, step in block:
+                if step == 0: continue
+                npts = int(round(abs((stop - start)/step))) + 1
+                pts  = start + numpy.sign(stop - start)*abs(step)*numpy.arange(npts)
+                # adjoining regions share their end points
+                if len(vals) > 0 and abs(pts[0] - vals[-1]) < 1.e-6*abs(step):
+                    pts = pts[1:]
+                vals.extend(pts)
+            if len(vals) > 0:
+                axes[i] = numpy.array(vals)
+        return axes[0], axes[1]
+
+    def _map_x(self):
+        "x positions of map columns: as read in the first row, else nominal"
+        x = self.pos[0,0,:]
+        xnom = self._nominal_axes()[0]
+        if xnom is not None:
+            n = min(len(x), len(xnom))
+            x = numpy.array(x, dtype=float)
+            x[:n] = numpy.where(numpy.isnan(x[:n]), xnom[:n], x[:n])
+        return x
+
+    def _map_y(self, tmp_y, ny):
+        "y positions of ny map rows: as read, else nominal, else NaN"
+        y = numpy.empty(ny)
+        y.fill(numpy.nan)
+        ynom = self._nominal_axes()[1]
+        if ynom is not None:
+            y[:len(ynom)] = ynom[:ny]
+        n = min(len(tmp_y), ny)
+        read = numpy.array(tmp_y[:n], dtype=float)
+        y[:n] = numpy.where(numpy.isnan(read), y[:n], read)
+        return y
+
+    def _parse_lines(self, lines, state):
+        """parse lines from a line reader, carrying on from state"""
         while lines:
+            line = lines.peek()
+            if not line.endswith('\n') and not (
+                _is_dataline(line) and len(line.split()) == state.ncol):
+                # a line still being written: leave it for the next refresh
+                break
+            if _is_dataline(line):
+                # real numeric column data: parse the whole block at once
+                if self.columns is not None and state.usecols is None:
+                    state.usecols = self._select_columns(state)
+                nbytes = lines.nbytes
+                ncol   = state.ncol or len(line.split())
+                rows   = lines.read_block(ncol, usecols=state.usecols,
+                                          warn=self.ShowMessage)
+                state.mode = 'data'
+                if state.tmp_dat is None:
+                    # guess the number of rows left from the bytes left
+                    nleft = ((lines.size - lines.nbytes) * len(rows) /
+                             max(lines.nbytes - nbytes, 1))
+                    state.tmp_dat = _RowBuffer(rows.shape[1],
+                                               size=len(rows) + nleft + 1)
+                state.tmp_dat.append(rows)
+                # an unterminated last row is only read when complete
+                state.tail_rows = int(lines.tail != '')
+                self.ShowProgress( lines.nbytes* 100.0 /(lines.size+1))
+                continue
+
             key, raw = self._getline(lines)
-            iline= iline+1
-            if key is not None and key != mode:
-                mode = key
+            if key is not None and key != state.mode:
+                state.mode = key
+            mode = state.mode
 
             if (len(raw) < 3): continue
-            self.ShowProgress( iline* 100.0 /(maxlines+1))
+            self.ShowProgress( lines.nbytes* 100.0 /(lines.size+1))
 
             if mode == '2d':
                 self.dimension = 2
                 sx   = raw.split()
-                yval = float(sx[2])
-                tmp_y.append(yval)
-                ypos_name = sx[1]
-                mode = None
-                if len(tmp_dat)>0:
-                    ntotal_at_2d.append(len(tmp_dat))
+                try:
+                    ypos_name = sx[1]
+                    yval = float(sx[2])
+                except (IndexError, ValueError):
+                    yval = numpy.nan
+                state.tmp_y.append(yval)
+                state.mode = None
+                start = state.npts
+                if state.tmp_dat is not None: start += len(state.tmp_dat)
+                state.row_starts.append(start)
 
             elif mode == 'epics scan':             # real numeric column data
                 print 'Warning: file appears to have a second scan appended!'
+                state.finished = True
                 break
                 
-            elif mode == 'data':             # real numeric column data
-                tmp_dat.append(numpy.array([float(i) for i in raw.split()]))
+            elif mode == 'data':
+                pass
                 
             elif mode == '-----':
-                if col_legend is None:   
-                    col_legend = lines.pop()[1:].strip().split()
+                nextline = lines.peek()
+                if (state.col_legend is None and nextline is not None and
+                    nextline[:1] in (';', '#')):
+                    state.col_legend = lines.pop()[1:].strip().split()
+                    state.ncol = len(state.col_legend)
 
             elif mode == '=====':   
                 pass
@@ -505,7 +1425,7 @@ class escan_data:
                 self.start_time = raw[20:].strip()
 
             elif mode == 'column labels':
-                col_details.append(raw[1:].strip())
+                state.col_details.append(raw[1:].strip())
 
             elif mode is None:
                 sx = [i.strip() for i in raw[1:].split('=')]
@@ -517,8 +1437,29 @@ class escan_data:
             else:
                 print 'UNKOWN MODE = ',mode, raw[:20]
 
+        if lines and not state.finished:
+            # stopped before an unterminated line
+            state.tail   = len(lines.peek())
+            state.offset = lines.nbytes
+        else:
+            state.tail   = len(lines.tail)
+            state.offset = lines.nbytes - state.tail
+
+    def read_ascii(self,fname=None):
+        """read ascii data file"""
+        lines = self._open_ascii(fname=fname)
+        if lines is None: return -1
+        
+        state = _ParseState()
+        self._parse_lines(lines, state)
+        lines.close()
+        tmp_dat = state.tmp_dat
+        if tmp_dat is None:
+            print 'Empty Scan File'
+            return -2
+
         try:        
-            col_details.pop(0)
+            state.col_details.pop(0)
             self.pv_list.pop(0)
         except IndexError:
             print 'Empty Scan File'
@@ -527,45 +1468,313 @@ class escan_data:
         if len(self.user_titles) > 1: self.user_titles.pop(0)
         if len(self.scan_regions) > 1: self.scan_regions.pop(0)
 
-        # check that 2d maps are of consistent size
+        state.npos = len([i for i in state.col_legend
+                          if i.lower().startswith('p')])
         if self.dimension == 2:
-            ntotal_at_2d.append(len(tmp_dat))
-            np_row0 = ntotal_at_2d[0]
-            nrows   = len(ntotal_at_2d)
-            npts    = len(tmp_dat)
-
-            if npts != np_row0 * nrows:
-                for i,n in enumerate(ntotal_at_2d):
-                    if n == np_row0*(i+1):
-                        nrows,npts_total = i+1,n
-
-                if len(tmp_y) > nrows or len(tmp_dat)> npts_total:
-                    print 'Warning: Some trailing data may be lost!'
-                    tmp_y = tmp_y[:nrows]
-                    tmp_dat = tmp_dat[:npts_total+1]
-            #
-        self.y = numpy.array(tmp_y)
-        # done reading file
-        # print 'read file -> make_arrays ', col_legend, col_details
-        # print type(tmp_dat), len(tmp_dat)
-        nlast = 0
-        oonpts = None
-        for irow,jcount in enumerate(ntotal_at_2d):
-            # print irow, jcount, oonpts
-            if oonpts is None: oonpts = jcount
-            if jcount-nlast != oonpts:
-                print 'Inconsistent number of points in data!'
-                # print irow, jcount,nlast, oonpts
-                return
-            nlast = jcount
-        
-        self._make_arrays(tmp_dat,col_legend,col_details)
-        tmp_dat = None
+            # 2d maps are laid out at their nominal size from the scan
+            # regions, or wider if the rows measured are longer, with NaN
+            # for points not (or not yet) measured
+            npts = len(tmp_dat)
+            xnom, ynom = self._nominal_axes()
+            starts = state.row_starts
+            nx = _row_length(starts, npts)
+            if xnom is not None: nx = max(nx, len(xnom))
+            ny = len(starts)
+            if ynom is not None: ny = max(ny, len(ynom))
+            if nx == 0 or ny == 0:
+                return -2
+            dat = numpy.empty((ny*nx, tmp_dat.data.shape[1]))
+            dat.fill(numpy.nan)
+            index, keep = _map_index(starts, 0, npts, nx)
+            dat[index] = tmp_dat.data[:npts][keep]
+            state.nx   = nx
+            state.npts = npts
+            self.y = self._map_y(state.tmp_y, ny)
+            self._make_arrays(dat, state.col_legend, state.col_details)
+        else:
+            state.npts = len(tmp_dat)
+            self._make_arrays(tmp_dat.finish(), state.col_legend,
+                              state.col_details)
+        state.tmp_dat = None
+        self._state   = state
         #
         self.has_fullxrf = False        
         if os.path.exists("%s.fullxrf" %fname):
             self.read_fullxrf("%s.fullxrf" %fname, len(self.x), len(self.y))
 
+    def set_readonly(self):
+        """mark the data arrays read-only, so they can be shared safely
+
+        stays in effect for arrays extended by refresh()"""
+        self.readonly = True
+        arrays = [getattr(self, attr) for attr in
+                  ('pos', 'det', 'sums', 'iocr', 'x', 'y')]
+        for arr in arrays + list(self._derived.values()):
+            if isinstance(arr, numpy.ndarray):
+                arr.flags.writeable = False
+
+    def refresh(self):
+        """read data rows appended to the file since it was last read
+
+        only the new rows are parsed, starting from where the last read
+        stopped; pos, det, sums and iocr are extended in place, and the
+        corrected arrays derived again when next used.  For 2d maps, new
+        points are written into their places in the (NaN padded) map.
+        Full XRF spectra are not followed.
+        A file that has been rewritten, or changed since it was loaded
+        from the cache, is read again from scratch.
+
+        Returns: the number of points added"""
+        nnew = self._refresh()
+        if self.readonly:
+            # new or re-read arrays are shared too
+            self.set_readonly()
+        return nnew
+
+    def _refresh(self):
+        state = self._state
+        if state is not None and state.finished:
+            return 0
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return 0
+        size = st.st_size
+        if state is None and self._cached_stat == (size, st.st_mtime):
+            return 0         # loaded from the cache, and unchanged since
+        if state is None or size < state.offset + state.tail:
+            return self._reread()
+        if size == state.offset + state.tail:
+            return 0
+
+        fh = open(self.filename, 'r')
+        fh.seek(state.offset)
+        lines = _LineReader(fh)
+        # rows from a half-written last line get parsed again
+        ntail = state.tail_rows
+        state.npts        -= ntail
+        state.tmp_dat      = None
+        state.tail_rows    = 0
+        self._parse_lines(lines, state)
+        lines.close()
+        if state.tmp_dat is None:
+            new = numpy.zeros((0, len(state.col_legend)))
+        else:
+            new = state.tmp_dat.finish()
+            state.tmp_dat = None
+
+        if self.dimension == 2:
+            self._place_points(new, state.npts)
+            state.npts += len(new)
+            return len(new) - ntail
+
+        self._append_points(new, state.npts)
+        state.npts += len(new)
+        self.x = self.pos[0]
+        return len(new) - ntail
+
+    def _reread(self):
+        """parse the whole file again, bypassing the cache
+
+        Returns: the change in the number of points"""
+        npts = self._npoints()
+        for attr in ('user_titles', 'scan_regions', 'pv_list',
+                     'pos_names', 'det_names'):
+            setattr(self, attr, [])
+        self.info = {}
+        self._state = None
+        if self.read_ascii(fname=self.filename) is not None:
+            return 0
+        return self._npoints() - npts
+
+    def _npoints(self):
+        "the number of points measured, not counting NaN padding of maps"
+        if len(self.pos) == 0:
+            return 0
+        return int(numpy.isfinite(self.pos[0]).sum())
+
+    def _place_points(self, rows, g0):
+        """put (npts, ncol) data rows for points g0 onwards of a 2d map into
+        their places in the map arrays
+
+        the arrays are written in place; they only grow, with NaN padding,
+        when more rows arrive than the scan regions called for, or a row
+        gets longer than any before"""
+        state = self._state
+        ny = max(len(state.row_starts), len(self.y))
+        nx = max(state.nx, _row_length(state.row_starts, g0 + len(rows)))
+        index, keep = _map_index(state.row_starts, g0, g0 + len(rows), nx)
+        dat = rows[keep].transpose()
+        new = {'pos': self._store(dat[:state.npos])}
+        new['det'], new['sums'], new['iocr'] = self._derive(dat[state.npos:])
+        # corrected arrays are derived again when next asked for
+        self._derived.clear()
+        for attr in ('pos', 'det', 'sums', 'iocr'):
+            view = getattr(self, attr)
+            if view is None: continue
+            full = self._full.get(attr)
+            if full is None or view.base is not full:
+                # first update: take a private, writable copy
+                full = view.copy()
+            if full.dtype.kind != 'f' and (new[attr].dtype.kind == 'f' or
+                                           ny > full.shape[1] or
+                                           nx > full.shape[2]):
+                # counts that no longer fit uint32, or NaN padding
+                full = full.astype(self._float_dtype())
+            if ny > full.shape[1] or nx > full.shape[2]:
+                nrow = full.shape[1]
+                if ny > nrow: nrow = max(ny, 2*nrow)
+                grown = numpy.empty((full.shape[0], nrow, nx),
+                                    dtype=full.dtype)
+                grown.fill(numpy.nan)
+                grown[:, :full.shape[1], :full.shape[2]] = full
+                full = grown
+            full.reshape((full.shape[0], -1))[:, index] = new[attr]
+            self._full[attr] = full
+            setattr(self, attr, full[:, :ny])
+        state.nx = nx
+        self.x = self._map_x()
+        self.y = self._map_y(state.tmp_y, ny)
+
+    def _append_points(self, rows, n):
+        """append (npts, ncol) data rows after the first n points of the
+        arrays of a 1d scan"""
+        dat = rows.transpose()
+        npos = self._state.npos
+        new = {'pos': self._store(dat[:npos])}
+        new['det'], new['sums'], new['iocr'] = self._derive(dat[npos:])
+        # corrected arrays are derived again when next asked for
+        self._derived.clear()
+        for attr in ('pos', 'det', 'sums', 'iocr'):
+            arr = new[attr]
+            if arr is None: continue
+            if arr.dtype != getattr(self, attr).dtype:
+                # counts that no longer fit uint32: store both as floats
+                dtype = self._float_dtype()
+                arr = arr.astype(dtype)
+                setattr(self, attr, getattr(self, attr).astype(dtype))
+                self._full[attr] = None
+            full, view = _extend(self._full.get(attr), getattr(self, attr),
+                                 arr, n)
+            self._full[attr] = full
+            setattr(self, attr, view)
+
+    def get_spectrum(self, ix, iy=0, det=None):
+        """full XRF spectrum at pixel (ix, iy)
+
+        summed over detector elements, unless det gives an element
+        index.  Only the pages of the spectra memmap for that pixel are
+        read."""
+        if not self.has_fullxrf:
+            return None
+        if self.dimension == 2:
+            spec = self.xrf_data[iy, ix]
+        else:
+            spec = self.xrf_data[ix]
+        if det is not None:
+            return numpy.array(spec[det])
+        return spec.sum(axis=0)
+
+    def get_region_spectrum(self, xslice, yslice=None, det=None):
+        """full XRF spectrum summed over a rectangular region of pixels
+
+        xslice and yslice are slice objects into the map; the sum is over
+        detector elements too, unless det gives an element index."""
+        if not self.has_fullxrf:
+            return None
+        if self.dimension == 2:
+            if yslice is None: yslice = slice(None)
+            rows = self.xrf_data[yslice, xslice]
+        else:
+            rows = self.xrf_data[xslice][numpy.newaxis]
+        # one row of pixels at a time, to keep the working set small
+        total = numpy.zeros(self.xrf_data.shape[-2:])
+        for row in rows:
+            total += row.sum(axis=0)
+        if det is not None:
+            return total[det]
+        return total.sum(axis=0)
+
+    def _get_xrf_index(self):
+        """cumulative sums of the full XRF spectra along the channel axis
+
+        returns an array of shape (nchan+1,) + xrf_data.shape[:-1], with
+        index[k] the counts in the channels below k, so the counts in
+        channels lo to hi-1 are index[hi] - index[lo].  Channels come
+        first, so each index[k] is one contiguous block.  The sums are
+        kept as xrf_dtype and may wrap around, but the differences are
+        exact for any window holding fewer than 2**32 counts.
+
+        built once, into a memmap next to the spectra memmap if there is
+        one, a row of pixels at a time."""
+        if self._xrf_index is not None:
+            return self._xrf_index
+        cube  = self.xrf_data
+        shape = (cube.shape[-1] + 1,) + cube.shape[:-1]
+        mapname = None
+        if isinstance(cube, numpy.memmap) and cube.filename is not None:
+            mapname = "%s_index.xrf" % os.path.splitext(cube.filename)[0]
+        if mapname is not None and os.path.exists(mapname):
+            try:
+                os.utime(mapname, None)
+            except OSError:
+                pass
+            self._xrf_index = numpy.memmap(mapname, dtype=xrf_dtype,
+                                           mode='r', shape=shape)
+            return self._xrf_index
+
+        def fill(index):
+            index[0] = 0
+            for i in range(len(cube)):
+                sums = numpy.cumsum(cube[i], axis=-1, dtype=xrf_dtype)
+                index[1:, i] = numpy.moveaxis(sums, -1, 0)
+
+        index = None
+        if mapname is not None:
+            try:
+                with atomic_write(mapname) as tmpname:
+                    index = numpy.memmap(tmpname, dtype=xrf_dtype,
+                                         mode='w+', shape=shape)
+                    fill(index)
+                    index.flush()
+                    del index
+                index = numpy.memmap(mapname, dtype=xrf_dtype, mode='r',
+                                     shape=shape)
+                clean_cache(keep=[mapname] + self._mapped_files())
+            except (OSError, IOError, ValueError):
+                index = None
+        if index is None:
+            index = numpy.empty(shape, dtype=xrf_dtype)
+            fill(index)
+        self._xrf_index = index
+        return index
+
+    def get_roi_map(self, emin, emax, det=None):
+        """map of the full XRF counts with energies from emin to emax
+
+        summed over detector elements, unless det gives an element index
+        or a list of them.  The window is found on each element's own
+        energy axis, and the counts are the difference of two planes of
+        the cumulative-sum index, so a new window costs the same however
+        many channels it spans."""
+        if not self.has_fullxrf:
+            return None
+        index = self._get_xrf_index()
+        dets  = det
+        if det is None:
+            dets = range(index.shape[-1])
+        dets = numpy.atleast_1d(dets)
+        lo = numpy.array([numpy.searchsorted(self.xrf_energies[d], emin)
+                          for d in dets])
+        hi = numpy.array([numpy.searchsorted(self.xrf_energies[d], emax,
+                                             side='right') for d in dets])
+        hi = numpy.maximum(hi, lo)
+        # one (ndet, ...) plane from each end of the windows
+        counts = index[hi, ..., dets] - index[lo, ..., dets]
+        if det is not None and numpy.ndim(det) == 0:
+            return counts[0].astype(float)
+        return counts.sum(axis=0, dtype=float)
+
     def read_fullxrf(self,xrfname, n_xin, n_yin):
         inpf = open(xrfname,'r')
 
@@ -576,11 +1785,12 @@ class escan_data:
 
         first_line = inpf.readline()
         if not first_line.startswith('; MCA Spectra'):
-            print 'Warning: %s is not a QuadXRF File' % xrffile
+            print 'Warning: %s is not a QuadXRF File' % xrfname
             inpf.close()
             return
         
         self.has_fullxrf = True
+        self._xrf_index = None
         isHeader= True
         nheader = 0
         header = {'CAL_OFFSET':None,'CAL_SLOPE':None,'CAL_QUAD':None}
@@ -652,96 +1862,198 @@ TWO_THETA:   10.0000000 10.0000000 10.0000000 10.0000000"""
         for i in range(ndet):
             off   = header['CAL_OFFSET'][i]
             slope = header['CAL_SLOPE'][i]
-            quad  = header['CAL_SLOPE'][i]            
+            quad  = header['CAL_QUAD'][i]
             self.xrf_energies.append(off + x_en * (slope + x_en * quad))
 
         self.xrf_energies = numpy.array(self.xrf_energies)
 
-        self.xrf_dict = {}
-        processing = True
-        iyold = 1
-        ix    = 0
-        t0 = time.time()
-
-        lines = inpf.readlines()
-        n_print = 100
-        for il, line in enumerate(lines):
-            try:
-                dat = [int(i) for i in line[:-1].split()]
-                ix  = dat.pop(0)
-                iy  = dat.pop(0)
-                if iy != iyold:
-                    iyold = iy
-
-                self.xrf_dict['%i/%i' % (ix,iy)] =dat
-                show_progress = self.progress
-                self.progress = self.my_progress
-                if (il % n_print) == 0: self.PrintMessage('. ')
-                self.progress = show_progress
-            except KeyboardInterrupt:
-                return -3
         xrf_shape =  (n_xin, ndet, n_energies)
         if self.dimension == 2:
-            xrf_shape =  (n_yin, n_xin, ndet, n_energies)            
-            
-        self.xrf_data = numpy.zeros(xrf_shape)
-        if self.dimension == 2:
-            for iy in range(n_yin):
-                for ix in range(n_xin):
-                    key = '%i/%i' % (ix+1,iy+1)
-                    d = numpy.array(self.xrf_dict[key])
-                    d.shape = (ndet, n_energies)
-                    self.xrf_data[iy,ix,:,:] = d
-        else:
-            for ix in range(n_xin):
-                key = '%i/%i' % (ix+1,iy)
-                d = numpy.array(self.xrf_dict[key])
-                d.shape = (ndet, n_energies)
-                self.xrf_data[ix,:,:] = d
-            
-        self.xrf_dict = None
-        # print 'XRF DATA  ',  iy, self.xrf_data.shape
-        # print self.xrf_data[0,0,:,:]
+            xrf_shape =  (n_yin, n_xin, ndet, n_energies)
+
+        # the spectra go into an integer memmap in cache_dir, built once
+        # per .fullxrf file: later loads only map it, and only the pages
+        # of the pixels actually looked at are ever read from disk.
+        mapname = cache_name(xrfname, suffix='_%s.xrf' %
+                             'x'.join(['%i' % i for i in xrf_shape]))
+        if mapname is not None and os.path.exists(mapname):
+            inpf.close()
+            try:
+                os.utime(mapname, None)
+            except OSError:
+                pass
+            self.xrf_data = numpy.memmap(mapname, dtype=xrf_dtype,
+                                         mode='r', shape=xrf_shape)
+            return
+
+        # parse the body in bulk, a chunk of lines at a time, as a
+        # (npix, 2 + ndet*n_energies) array of ix, iy, spectra, and
+        # scatter each chunk into the cube with one indexed assignment.
+        ncol   = 2 + ndet*n_energies
+        size   = os.fstat(inpf.fileno()).st_size
+        start  = inpf.tell()
+        def fill(cube):
+            inpf.seek(start)
+            nbytes = 0
+            while True:
+                lines = inpf.readlines(self.xrf_chunksize)
+                if not lines: break
+                nbytes += sum([len(l) for l in lines])
+                body = _parse_rows(''.join(lines), len(lines), ncol,
+                                   dtype=xrf_dtype)
+                ix, iy = body[:,0].astype(int) - 1, body[:,1].astype(int) - 1
+                spectra = body[:,2:].reshape((-1, ndet, n_energies))
+                if self.dimension == 2:
+                    ok = (ix >= 0) & (ix < n_xin) & (iy >= 0) & (iy < n_yin)
+                    cube[iy[ok], ix[ok]] = spectra[ok]
+                else:
+                    ok = (ix >= 0) & (ix < n_xin)
+                    cube[ix[ok]] = spectra[ok]
+                self.ShowProgress(nbytes*100.0/(size+1))
+
+        cube = None
+        try:
+            if mapname is not None:
+                try:
+                    with atomic_write(mapname) as tmpname:
+                        cube = numpy.memmap(tmpname, dtype=xrf_dtype,
+                                            mode='w+', shape=xrf_shape)
+                        fill(cube)
+                        cube.flush()
+                        del cube
+                    cube = numpy.memmap(mapname, dtype=xrf_dtype,
+                                        mode='r', shape=xrf_shape)
+                    clean_cache(keep=[mapname])
+                except (OSError, IOError, ValueError):
+                    cube = None
+            if cube is None:
+                # no usable cache directory: keep the spectra in memory
+                cube = numpy.zeros(xrf_shape, dtype=xrf_dtype)
+                fill(cube)
+        except KeyboardInterrupt:
+            inpf.close()
+            return -3
         inpf.close()
+        self.xrf_data = cube
         
 
-    def get_detector_list(self,name=None,index=None,use_orig=None):
-        l = []
-        if name is not None:
-            idet = self.match_detector_name(name)
-            for i in range(len(m)):
-                if (idet == m[i]):
-                    l.append(i)
-        return l        
+    def get_detector_list(self,name=None):
+        """return the list of detectors added up in the sum called name
+
+        name may also be a detector name, for the sum it belongs to"""
+        if name in self.sums_names:
+            return self._sum_members(self.sums_names.index(name))
+        idet = self.match_detector_name(name)
+        for i in range(len(self.sums_list)):
+            if idet in self._sum_members(i):
+                return self._sum_members(i)
+        return []
 
     def set_detector_list(self,name=None,list=[]):
         " reset list of detectors for sum"
-        i1 = self.match_detector_name(name)
-        tmp_list = []
-        for i,det in enumerate(self.det_names):
-            nam,pv = det
-            l  = self.get_detector_list(nam)
-            if (i == i1):  l = list
-            tmp_list.append(l)
-            
-        self.sums_list = []
-        for i in range(self.ndetectors): self.sums_list.append(-1)
-        for i in range(len(self.det_names)):
-            for k in tmp_list[i]: self.sums_list[k] = i
-
-        # re-make sums from detector lists
-        # note use of copy.deepcopy()!!
-        self.sums    = []
-        for i in range(len(self.det_names)):
-            l = tmp_list[i]
-            if (len(l) > 0):
-                t = self.det[l[0]]
-                for j in range(1,len(l)):
-                    t = t + self.det[l[j]]
-            self.sums.append(copy.deepcopy(t))
-        self.sums = numpy.array(self.sums)
-
-
+        self.regroup({name: list})
+
+    def regroup(self, groups):
+        """change which detectors are added up in the sums
+
+        groups maps a sum name to the list of detectors (indices into
+        det_names, or detector names) it should add up.  Sums not named
+        keep their detectors; new names are added as new sums, and an
+        empty list leaves a sum of zeros.  Only the sums named are
+        recomputed, and the corrected sums follow."""
+        changed = {}
+        for name, members in groups.items():
+            idets = []
+            for d in members:
+                if not isinstance(d, (int, long)):
+                    d = self.match_detector_name(d, strict=True)
+                if d < 0 or d >= len(self.det_names):
+                    raise ValueError("no detector %r for sum '%s'" % (d, name))
+                idets.append(d)
+            if name not in self.sums_names:
+                self.sums_names.append(name)
+                self.sums_list.append([])
+            i = self.sums_names.index(name)
+            self.sums_list[i] = idets
+            if len(idets) == 1: self.sums_list[i] = idets[0]
+            changed[i] = idets
+        self._corr_index = None
+        self._name_index = None
+
+        nsums = len(self.sums_list)
+        rows = {}
+        for i, idets in changed.items():
+            rows[i] = numpy.zeros(self.det.shape[1:])
+            if len(idets) > 0:
+                rows[i] = self.det[_members_index(idets)].sum(axis=0)
+        self.sums = _set_rows(self.sums, rows, nsums, self._store)
+        self._full.pop('sums', None)
+
+        # corrected arrays: only the full sums_corr is patched, the rest
+        # are derived again when next asked for
+        for key in self._derived.keys():
+            if (isinstance(key, tuple) and
+                (key[0] in ('expr', 'get_data') or
+                 (key[0] == 'sums_corr' and key[1] in changed))):
+                del self._derived[key]
+        if self.iocr is not None and 'sums_corr' in self._derived:
+            rows = dict((i, self._calc_corr(i, True)) for i in changed)
+            self._derived['sums_corr'] = _set_rows(self._derived['sums_corr'],
+                                                   rows, nsums)
+        if self.readonly:
+            self.set_readonly()
+
+
+# scans opened through open_scan(), shared by everyone who asks for the
+# same file: (path, mtime) -> [escan_data, number of users]
+_registry = {}
+
+def _registry_key(value):
+    "value, or a hashable stand-in for it, for keying the scan registry"
+    if isinstance(value, dict):
+        return tuple(sorted((k, _registry_key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple([_registry_key(v) for v in value])
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+def open_scan(fname, data=None, **kws):
+    """return a shared, read-only escan_data for fname
+
+    the scan is parsed on the first request for a given path, mtime and
+    set of escan_data keywords (other than the message and progress
+    callbacks); later requests get the same object.  data may give a
+    scan of fname that has already been parsed (in a worker process,
+    say) to register in its place.  Each call should be matched by a
+    release_scan().
+    """
+    opts  = dict((k, v) for k, v in kws.items()
+                 if k not in ('message', 'progress'))
+    key   = (os.path.abspath(fname), os.stat(fname).st_mtime,
+             _registry_key(opts))
+    entry = _registry.get(key, None)
+    if entry is None:
+        if data is None:
+            data = escan_data(file=fname, **kws)
+        data.set_readonly()
+        entry = _registry[key] = [data, 0]
+    entry[1] += 1
+    return entry[0]
+
+def release_scan(data):
+    """drop one use of a scan from open_scan()
+
+    the last release forgets the scan, so its arrays can be freed once
+    the caller drops its own reference"""
+    for key, entry in list(_registry.items()):
+        if entry[0] is data:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del _registry[key]
+            return
 
 if (__name__ == '__main__'):
     import sys
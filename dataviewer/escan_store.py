@@ -0,0 +1,186 @@
+#!/usr/bin/python
+"""
+columnar store for parsed Epics scans
+
+write_store() saves an escan_data as an HDF5 file in which every
+positioner, detector, sum and icr/ocr channel is its own chunked,
+compressed array, next to a small JSON header holding the scan's names
+and metadata.  ScanStore reads the header when opened, and each channel
+only when it is asked for, so pulling one channel out of many stores
+reads little more than that channel:
+
+    for fname in stores:
+        s = ScanStore(fname)
+        maps.append(s.get_data('As Ka', norm='i0'))
+        s.close()
+
+The full XRF cube, if any, is stored chunked by pixel, so get_spectrum()
+reads a single spectrum.
+"""
+import json
+import numpy
+
+try:
+    import h5py
+    has_h5 = True
+except ImportError:
+    has_h5 = False
+
+import channel_expr
+from escan_data import iocr_index, _h5value, _h5value_attr
+
+store_title   = 'Epics Scan Store'
+store_version = '1.0'
+
+# header entries, copied from and to escan_data attributes
+header_attrs = ('filename', 'dimension', 'start_time', 'stop_time',
+                'xpos', 'ypos', 'correct_deadtime', 'pos_names',
+                'det_names', 'sums_names', 'sums_list', 'pv_list',
+                'scan_regions', 'user_titles', 'info')
+
+def _write_rows(group, arr, compression=4):
+    "write each row of arr as its own chunked, compressed dataset"
+    for i in range(len(arr)):
+        group.create_dataset(str(i), data=arr[i], chunks=True,
+                             compression=compression, shuffle=True)
+
+def write_store(scan, fname, fullxrf=True, compression=4):
+    """save the escan_data scan as a columnar store in fname
+
+    with fullxrf, the full XRF spectra are saved too, if the scan has
+    them"""
+    if not has_h5:
+        raise ImportError("escan_store needs h5py")
+    fout = h5py.File(fname, 'w')
+    try:
+        fout.attrs['Title']   = store_title
+        fout.attrs['Version'] = store_version
+        header = dict((attr, getattr(scan, attr)) for attr in header_attrs)
+        fout['header'] = json.dumps(header)
+        fout['x'] = scan.x
+        if scan.dimension > 1:
+            fout['y'] = scan.y
+        for attr in ('pos', 'det', 'sums', 'iocr'):
+            arr = getattr(scan, attr)
+            if arr is not None:
+                _write_rows(fout.create_group(attr), arr, compression)
+
+        if fullxrf and scan.has_fullxrf:
+            g = fout.create_group('full_xrf')
+            g['header']   = scan.xrf_header
+            g['energies'] = scan.xrf_energies
+            cube  = scan.xrf_data
+            chunk = (1,)*(cube.ndim - 2) + cube.shape[-2:]
+            dset  = g.create_dataset('data', shape=cube.shape,
+                                     dtype=cube.dtype, chunks=chunk,
+                                     compression=compression, shuffle=True)
+            # a row of pixels at a time, to keep memmapped cubes paged out
+            for i in range(len(cube)):
+                dset[i] = cube[i]
+    finally:
+        fout.close()
+
+class ScanStore:
+    """ read-only access to a scan saved by write_store()
+
+    the header entries (pos_names, det_names, sums_names, pv_list,
+    scan_regions, info, ...) are attributes; channel data is read from the
+    file by get_data() only when asked for.
+    """
+    def __init__(self, fname):
+        if not has_h5:
+            raise ImportError("escan_store needs h5py")
+        self.fname = fname
+        self.h5 = h5py.File(fname, 'r')
+        try:
+            title = _h5value_attr(self.h5, 'Title')
+        except KeyError:
+            title = None
+        if title != store_title:
+            self.h5.close()
+            raise IOError("%s is not an Epics scan store" % fname)
+        header = json.loads(_h5value(self.h5['header']))
+        for attr in header_attrs:
+            setattr(self, attr, header[attr])
+        self.pos_names = [tuple(i) for i in self.pos_names]
+        self.det_names = [tuple(i) for i in self.det_names]
+        self.x = _h5value(self.h5['x'])
+        self.y = []
+        if 'y' in self.h5:
+            self.y = _h5value(self.h5['y'])
+        self.has_fullxrf = 'full_xrf' in self.h5
+        self._iocr_index = iocr_index(self.det_names)
+
+    def close(self):
+        self.h5.close()
+
+    def get_channel_names(self):
+        "names of all channels: sums, then detectors, then positioners"
+        return (list(self.sums_names) + [d[0] for d in self.det_names] +
+                [p[0] for p in self.pos_names])
+
+    def _find_channel(self, name):
+        """return (kind, index) of the sum, detector or positioner named
+        exactly name (ignoring case), or None"""
+        for kind, names in (('sums', self.sums_names),
+                            ('det', [d[0] for d in self.det_names]),
+                            ('pos', [p[0] for p in self.pos_names])):
+            i = channel_expr.find_name(names, name)
+            if i is not None:
+                return kind, i
+        return None
+
+    def _read(self, kind, i):
+        return self.h5['%s/%i' % (kind, i)][()]
+
+    def _channel_array(self, kind, i, icr_correct=True):
+        "data for channel i of kind 'sums', 'det' or 'pos'"
+        if kind == 'pos':
+            return self._read('pos', i)
+        if not icr_correct or 'iocr' not in self.h5:
+            return self._read(kind, i)
+        members = [i]
+        if kind == 'sums':
+            members = self.sums_list[i]
+            if not isinstance(members, list): members = [members]
+        out = 0.
+        for j in members:
+            dat = self._read('det', j)
+            if self._iocr_index[j] >= 0:
+                dat = dat * self._read('iocr', self._iocr_index[j])
+            out = out + dat
+        return out
+
+    def _getarray(self, name, icr_correct=True):
+        def fetch(found):
+            return self._channel_array(found[0], found[1], icr_correct)
+        return channel_expr.lookup(name, self._find_channel, fetch,
+                                   ddx=self._ddx)
+
+    def _ddx(self, arr):
+        "derivative of arr with respect to the first positioner"
+        x = self._read('pos', 0)
+        arr = numpy.broadcast_to(arr, x.shape)
+        return numpy.gradient(arr, axis=-1)/numpy.gradient(x, axis=-1)
+
+    def get_data(self, name, norm=None, icr_correct=True):
+        """return data for a channel name (or expression of channel names,
+        see channel_expr), reading only the arrays it needs"""
+        def getarray(cname):
+            return self._getarray(cname, icr_correct=icr_correct)
+        return channel_expr.get_data(getarray, name, norm,
+                                     getnorm=self._getarray)
+
+    def get_spectrum(self, ix, iy=0, det=None):
+        """full XRF spectrum at pixel (ix, iy), summed over detector
+        elements unless det gives an element index"""
+        if not self.has_fullxrf:
+            return None
+        dset = self.h5['full_xrf/data']
+        if self.dimension == 2:
+            spec = dset[iy, ix]
+        else:
+            spec = dset[ix]
+        if det is not None:
+            return spec[det]
+        return spec.sum(axis=0)
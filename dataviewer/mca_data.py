@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""
+reader for multi-element MCA spectra files (.xrf)
+
+the header holds 'KEY: values' lines with one value per detector element
+for the energy calibration (CAL_OFFSET, CAL_SLOPE, CAL_QUAD), the
+REAL_TIME and LIVE_TIME, and the ROIs (ROI_n_LEFT, ROI_n_RIGHT and
+ROI_n_LABEL, whose labels are separated by '&').  After 'DATA:' come
+CHANNELS lines of ELEMENTS counts each.
+
+The counts are kept as one (nelem, nchan) integer array, and the energy
+axes, ROI integrals and summed spectra are computed for all elements at
+once.
+"""
+import re
+import numpy
+
+from escan_data import xrf_dtype, _parse_rows
+
+def sniff(head):
+    """whether head, the first bytes of a file, starts with the VERSION,
+    ELEMENTS and CHANNELS lines of an MCA file"""
+    return (head.startswith('VERSION:') and
+            re.search(r'^ELEMENTS:', head, re.M) is not None and
+            re.search(r'^CHANNELS:', head, re.M) is not None)
+
+def _calibrate(offset, slope, quad, chan):
+    "energies at channels chan, one row per element"
+    offset, slope, quad = [numpy.asarray(a)[:, numpy.newaxis]
+                           for a in (offset, slope, quad)]
+    return offset + chan*(slope + chan*quad)
+
+class MCAData:
+    """ a multi-element MCA spectra file
+
+    attributes:
+        filename
+        header:     dict of the raw header values, by key
+        nelem, nchan
+        real_time, live_time:  (nelem,) arrays
+        energies:   (nelem, nchan) array, energy of each channel of each
+                    element
+        calibrated: (nelem,) array, whether each element has a usable
+                    energy calibration (see _check_calibration)
+        energy:     the energy axis summed spectra are given on: that of
+                    the first calibrated element, extended to cover the
+                    ranges of the others
+        channels:   channel numbers of that element along energy, going
+                    below 0 and past nchan where it was extended
+        counts:     (nelem, nchan) array of raw counts
+        roi_names:  ROI labels
+        roi_left, roi_right:  (nroi, nelem) arrays of the first and last
+                    channel of each ROI for each element, -1 where an
+                    element does not have that ROI
+    """
+    def __init__(self, fname):
+        self.filename = fname
+        self.header = {}
+        self.read_file(fname)
+
+    def _values(self, key, dtype=float):
+        return numpy.array(self.header[key].split(), dtype=dtype)
+
+    def read_file(self, fname):
+        f = open(fname, 'r')
+        text = f.read()
+        f.close()
+        idata = text.find('DATA:')
+        if idata < 0:
+            raise ValueError("%s has no DATA section" % fname)
+        for line in text[:idata].splitlines():
+            if ':' in line:
+                key, val = line.split(':', 1)
+                self.header[key.strip()] = val.strip()
+
+        self.nelem = int(self.header['ELEMENTS'])
+        self.nchan = int(self.header['CHANNELS'])
+        counts = _parse_rows(text[idata+5:], self.nchan, self.nelem,
+                             dtype=xrf_dtype)
+        self.counts = numpy.ascontiguousarray(counts.transpose())
+        self.nchan  = self.counts.shape[1]
+
+        self.real_time = self._values('REAL_TIME')
+        self.live_time = self._values('LIVE_TIME')
+        self._calib = [self._values(k)
+                       for k in ('CAL_OFFSET', 'CAL_SLOPE', 'CAL_QUAD')]
+        self.energies = _calibrate(*(self._calib +
+                                     [numpy.arange(self.nchan)]))
+        self._edges = _calibrate(*(self._calib +
+                                   [numpy.arange(self.nchan + 1) - 0.5]))
+        self.calibrated = self._check_calibration()
+        if not self.calibrated.all():
+            bad = ', '.join([str(i+1) for i in
+                             numpy.flatnonzero(~self.calibrated)])
+            print ('Warning: no usable energy calibration for element %s'
+                   ' of %s' % (bad, fname))
+        self._make_axis()
+        self._read_rois()
+
+    def _check_calibration(self):
+        """whether each element's calibration is usable: its energies must
+        increase with channel number, and its channel width be within a
+        factor of 10 of the median over all elements, which catches
+        calibrations left at defaults or given in other units"""
+        widths = numpy.diff(self._edges, axis=1)
+        ok = (widths > 0).all(axis=1)
+        if not ok.any():
+            return ok
+        width = widths.mean(axis=1)
+        median = numpy.median(width[ok])
+        return ok & (width < 10*median) & (width > median/10)
+
+    def _make_axis(self):
+        """set up the energy axis spectra are given on: the channels of
+        the first calibrated element, with channels of its end widths
+        added below and above to take in the ranges of the others"""
+        good = numpy.flatnonzero(self.calibrated)
+        if len(good) == 0:
+            self._axis    = self._edges[0]
+            self.energy   = self.energies[0]
+            self.channels = numpy.arange(self.nchan)
+            return
+        ref   = good[0]
+        edges = self._edges[ref]
+        wlo, whi = edges[1] - edges[0], edges[-1] - edges[-2]
+        nlo = int(numpy.ceil((edges[0] - self._edges[good, 0].min())/wlo
+                             - 1.e-6))
+        nhi = int(numpy.ceil((self._edges[good, -1].max() - edges[-1])/whi
+                             - 1.e-6))
+        nlo, nhi = max(nlo, 0), max(nhi, 0)
+        self._axis = numpy.concatenate((
+                edges[0] - wlo*numpy.arange(nlo, 0, -1), edges,
+                edges[-1] + whi*numpy.arange(1, nhi + 1)))
+        centers = 0.5*(self._axis[1:] + self._axis[:-1])
+        self.energy = numpy.concatenate((centers[:nlo], self.energies[ref],
+                                         centers[nlo + self.nchan:]))
+        self.channels = numpy.arange(-nlo, self.nchan + nhi)
+
+    def _read_rois(self):
+        """collect the ROIs by label: the n-th ROI of one element need not
+        be the n-th ROI of another"""
+        nrois = self._values('ROIS', dtype=int)
+        self.roi_names = []
+        left, right = [], []
+        for n in range(nrois.max() if len(nrois) else 0):
+            lo = self._values('ROI_%i_LEFT' % n, dtype=int)
+            hi = self._values('ROI_%i_RIGHT' % n, dtype=int)
+            labels = self.header['ROI_%i_LABEL' % n].split('&')
+            for i in range(self.nelem):
+                label = ' '.join(labels[i].split())
+                if n >= nrois[i] or label == '':
+                    continue
+                if label not in self.roi_names:
+                    self.roi_names.append(label)
+                    left.append(-numpy.ones(self.nelem, dtype=int))
+                    right.append(-numpy.ones(self.nelem, dtype=int))
+                j = self.roi_names.index(label)
+                left[j][i], right[j][i] = lo[i], hi[i]
+        shape = (len(self.roi_names), self.nelem)
+        self.roi_left  = numpy.array(left, dtype=int).reshape(shape)
+        self.roi_right = numpy.array(right, dtype=int).reshape(shape)
+
+    def get_roi_counts(self, livetime_correct=False):
+        """(nroi, nelem) array of the counts in each ROI of each element,
+        0 where an element does not have that ROI
+
+        taken from the cumulative counts of each element, two values per
+        ROI.  With livetime_correct, counts are divided by each element's
+        live time, giving counts per second."""
+        cum = numpy.zeros((self.nelem, self.nchan + 1), dtype=numpy.uint64)
+        numpy.cumsum(self.counts, axis=1, out=cum[:, 1:])
+        elem  = numpy.arange(self.nelem)
+        valid = self.roi_left >= 0
+        lo = numpy.clip(self.roi_left, 0, self.nchan)
+        hi = numpy.clip(self.roi_right + 1, 0, self.nchan)
+        out = numpy.where(valid, cum[elem, hi] - cum[elem, lo], 0)
+        out = out.astype(float)
+        if livetime_correct:
+            out = out / self.live_time
+        return out
+
+    def get_spectrum(self, elem=None, livetime_correct=False):
+        """spectrum of element elem, or summed over all elements if elem is
+        None
+
+        an element's spectrum is its raw counts, on its own channels:
+        energies[elem].  The elements have their own calibrations, so for
+        the sum each element's counts are moved onto the axis self.energy
+        by interpolating its cumulative counts at the channel edges, which
+        keeps the total number of counts; elements without a usable
+        calibration are left out.  With livetime_correct, counts are
+        divided by each element's live time, giving counts per second."""
+        if elem is not None:
+            if livetime_correct:
+                return self.counts[elem] / self.live_time[elem]
+            return self.counts[elem]
+        cum = numpy.zeros((self.nelem, self.nchan + 1))
+        numpy.cumsum(self.counts, axis=1, out=cum[:, 1:])
+        if livetime_correct:
+            cum = cum / self.live_time[:, numpy.newaxis]
+        total = numpy.zeros(len(self._axis))
+        for i in range(self.nelem):
+            if self.calibrated[i]:
+                total += numpy.interp(self._axis, self._edges[i], cum[i])
+        return numpy.diff(total)
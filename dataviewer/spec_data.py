@@ -0,0 +1,155 @@
+#!/usr/bin/python
+"""
+reader for SPEC data files
+
+a SPEC file holds many scans one after another, each starting with a
+'#S number command' line.  SpecFile finds the byte offset of every '#S'
+line in one pass (a regular expression over a memory map of the file),
+and parses a scan only when get_scan() asks for it:
+
+    f = SpecFile('spec_data.dat')
+    for number, title in f.get_scan_list():
+        ...
+    s = f.get_scan(0)
+    y = s.get_data('PMT', norm='Monitor')
+
+The index is saved in the escan_data cache directory, keyed on the
+file's size and mtime like the parse cache, so reopening an unchanged
+file does not scan it again.
+"""
+import os
+import re
+import json
+import mmap
+import numpy
+
+import channel_expr
+from escan_data import cache_name, clean_cache, atomic_write, _parse_rows
+
+_scan_line = re.compile(r'^#S[ \t]+(\S+)[ \t]*(.*?)\s*$', re.M)
+
+def sniff(head):
+    """whether head, the first bytes of a file, starts with SPEC '#'
+    control lines, one of them '#F' or '#S'"""
+    lines = [l for l in head.splitlines() if l.strip()]
+    if len(lines) == 0 or not re.match(r'#[A-Z]', lines[0]):
+        return False
+    return re.search(r'^#[FS][ \t]', head, re.M) is not None
+
+class SpecScan(channel_expr.Columns):
+    """ one scan of a SPEC file
+
+    attributes:
+        number:  scan number, as a string
+        title:   the command from the '#S' line
+        labels:  column names, from the '#L' line
+        header:  the other '#' lines of the scan
+        data:    (ncol, npts) array, one row per column
+    """
+    def __init__(self, number, title, text):
+        self.number = number
+        self.title  = title
+        self.labels = []
+        self.header = []
+        lines = text.splitlines(True)
+        # data lines only count after '#L': header blocks such as #G1
+        # may run on over lines that look numeric
+        start = len(lines)
+        for i, line in enumerate(lines):
+            if line.startswith('#L'):
+                self.labels = re.split(r'\s\s+', line[2:].strip())
+                start = i + 1
+            elif line.startswith('#'):
+                self.header.append(line.strip())
+        rows = [l for l in lines[start:]
+                if l.strip() and l[0] not in ('#', '@')]
+        ncol = len(self.labels)
+        if rows:
+            ncol = len(rows[0].split())
+        dat = _parse_rows(''.join(rows), len(rows), ncol)
+        self.data = dat.transpose()
+        for i in range(len(self.labels), ncol):
+            self.labels.append('col%i' % (i+1))
+        self.labels = self.labels[:ncol]
+
+class SpecFile:
+    """ a SPEC file, indexed by scan
+
+    scans are numbered by their position in the file, from 0, since SPEC
+    scan numbers may repeat (after a restart, say).  find_scan() looks up
+    a scan number.  Parsed scans are kept, so going back to a scan does
+    not parse it again.
+    """
+    def __init__(self, fname, use_cache=True):
+        self.filename = fname
+        self.index    = None      # list of (number, title, start, end)
+        self._scans   = {}
+        idxname = None
+        if use_cache:
+            idxname = cache_name(fname, suffix='-spec.json')
+        if idxname is not None:
+            try:
+                self.index = [(str(n), str(t), start, end) for
+                              n, t, start, end in json.load(open(idxname))]
+            except (IOError, OSError, ValueError):
+                self.index = None
+        if self.index is None:
+            self.index = self._make_index()
+            if idxname is not None:
+                try:
+                    self._write_index(idxname)
+                except (IOError, OSError):
+                    print 'Warning: could not write index file for %s' % fname
+
+    def _make_index(self):
+        "find every '#S' line in one pass over a memory map of the file"
+        fh = open(self.filename, 'rb')
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            fh.close()
+            return []
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        index = [[m.group(1), m.group(2), m.start()]
+                 for m in _scan_line.finditer(mm)]
+        mm.close()
+        fh.close()
+        for i in range(len(index)):
+            end = size
+            if i+1 < len(index): end = index[i+1][2]
+            index[i] = tuple(index[i] + [end])
+        return index
+
+    def _write_index(self, idxname):
+        "write the index to idxname atomically, then trim the cache"
+        with atomic_write(idxname) as tmpname:
+            f = open(tmpname, 'w')
+            json.dump(self.index, f)
+            f.close()
+        clean_cache(keep=[idxname])
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_scan_list(self):
+        "(number, title) of each scan, in file order"
+        return [(i[0], i[1]) for i in self.index]
+
+    def find_scan(self, number):
+        "position of the last scan numbered number, or None"
+        number = str(number)
+        for i in range(len(self.index)-1, -1, -1):
+            if self.index[i][0] == number:
+                return i
+        return None
+
+    def get_scan(self, i):
+        "the SpecScan at position i, read from the file only the first time"
+        scan = self._scans.get(i, None)
+        if scan is None:
+            number, title, start, end = self.index[i]
+            fh = open(self.filename, 'rb')
+            fh.seek(start)
+            text = fh.read(end - start)
+            fh.close()
+            scan = self._scans[i] = SpecScan(number, title, text)
+        return scan